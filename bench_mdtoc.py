@@ -0,0 +1,239 @@
+# Run:
+# $ python3 bench_mdtoc.py run --output baseline.json
+# $ python3 bench_mdtoc.py run --output current.json
+# $ python3 bench_mdtoc.py compare baseline.json current.json --threshold 0.25
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import mdtoc
+
+PROFILES = ['mixed', 'header_dense', 'deep', 'duplicates', 'long_headers', 'highlight']
+SIZES = [1000, 100000, 1000000]
+LONG_HEADER_SHAPES = ['title', 'fragments', 'anchor']
+LONG_HEADER_LENGTHS = [1000, 10000, 100000]
+STAGES = ['parse_headers', 'scan_buffer', 'generate_tags', 'generate_toc', 'add_anchor_tags', 'insert_toc', 'assemble_lines',
+          'add_toc']
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'parameters', 'returns', 'example',
+         'config', 'api', 'request', 'response', 'error', 'value', 'type']
+
+
+def random_title(rng, words=3):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def generate_document(line_count, profile='mixed', seed=0):
+    rng = random.Random(seed)
+    lines = ['# Generated document', '## Contents', '']
+
+    while len(lines) < line_count:
+        if profile == 'header_dense':
+            lines.append('#' * rng.randint(2, 4) + ' ' + random_title(rng))
+        elif profile == 'deep':
+            for level in range(1, 7):
+                lines.append('#' * level + ' ' + random_title(rng))
+            lines.append('text ' * 8)
+        elif profile == 'duplicates':
+            lines.append('## ' + random_title(rng, 1))
+            lines.append('### Parameters')
+            lines.append('text ' * 8)
+            lines.append('### Returns')
+            lines.append('text ' * 8)
+            lines.append('### Example')
+        elif profile == 'long_headers':
+            lines.append('## ' + random_title(rng, 200))
+            lines.extend(['text ' * 16] * 4)
+        elif profile == 'highlight':
+            lines.append('## ' + random_title(rng))
+            lines.append('{% highlight python %}')
+            lines.extend(['# comment ' + str(n) for n in range(50)])
+            lines.append('{% endhighlight %}')
+        else:
+            lines.append('#' * rng.randint(2, 4) + ' ' + random_title(rng))
+            lines.extend(['text ' * rng.randint(4, 16)] * rng.randint(2, 20))
+            lines.append('')
+
+    return lines[:line_count]
+
+
+def generate_long_header(length, shape='title'):
+    # Pathological header lines: a long title, a title of repeated anchor
+    # tag fragments, or a long anchor tag
+    if shape == 'fragments':
+        return '## ' + ('x<a name="' * (length // 10 + 1))[:length] + '></a>'
+    if shape == 'anchor':
+        return '## Title<a name="' + 'x' * length + '"></a>'
+    return '## ' + 'x' * length
+
+
+def time_call(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_stages(lines, repeat=3):
+    mt = mdtoc.MdToc()
+    results = {}
+
+    results['parse_headers'] = time_call(lambda: mt.parse_headers(lines), repeat)
+    data = mdtoc.join_lines(lines).encode('utf-8')
+    results['scan_buffer'] = time_call(lambda: mt.scan_buffer(data), repeat)
+    headers = mt.parse_headers(lines)
+    results['generate_tags'] = time_call(lambda: mt.generate_tags(headers), repeat)
+    results['generate_toc'] = time_call(lambda: mt.generate_toc(headers), repeat)
+
+    results['add_anchor_tags'] = time_call(lambda: mt.add_anchor_tags(lines, headers), repeat)
+
+    toc = mt.generate_toc(headers)
+    lines_with_tags = mt.add_anchor_tags(lines, headers)
+    results['insert_toc'] = time_call(lambda: mt.insert_toc(lines_with_tags, toc), repeat)
+    results['assemble_lines'] = time_call(lambda: mt.assemble_lines(lines, headers, toc), repeat)
+
+    results['add_toc'] = time_call(lambda: mt.add_toc(lines), repeat)
+
+    return results
+
+
+def measure_peak_memory(lines):
+    mt = mdtoc.MdToc()
+    tracemalloc.start()
+    mt.add_toc(lines)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def measure_header_memory(lines):
+    # Peak memory of parsed and tagged headers, as dicts and as a HeaderStore
+    mt = mdtoc.MdToc()
+    results = {}
+    for name, parse in [('dicts', mt.parse_headers), ('store', mt.parse_header_store)]:
+        tracemalloc.start()
+        headers = mt.generate_tags(parse(lines))
+        results[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del headers
+    return results
+
+
+def measure_long_headers(lengths, shapes=LONG_HEADER_SHAPES, repeat=3):
+    # Parsing time of documents with ten long header lines, which should
+    # grow no faster than the line length
+    mt = mdtoc.MdToc()
+    results = {}
+    for shape in shapes:
+        for length in lengths:
+            lines = ['## Contents'] + [generate_long_header(length, shape)] * 10
+            results['{}-{}'.format(shape, length)] = time_call(lambda: mt.parse_headers(lines), repeat)
+    return results
+
+
+def run(sizes, profiles, repeat=3, memory=True):
+    results = {}
+    for profile in profiles:
+        for size in sizes:
+            lines = generate_document(size, profile)
+            name = '{}-{}'.format(profile, size)
+            results[name] = {'lines': size,
+                             'stages': measure_stages(lines, repeat if size < 1000000 else 1)}
+            if memory:
+                results[name]['peak_memory'] = measure_peak_memory(lines)
+                results[name]['header_memory'] = measure_header_memory(lines)
+            print(name, ' '.join('{}={:.4f}s'.format(stage, results[name]['stages'][stage]) for stage in STAGES),
+                  file=sys.stderr)
+    long_headers = measure_long_headers(LONG_HEADER_LENGTHS, repeat=repeat)
+    print('long_headers', ' '.join('{}={:.6f}s'.format(name, seconds) for name, seconds in sorted(long_headers.items())),
+          file=sys.stderr)
+    return {'python': sys.version.split()[0], 'results': results, 'long_headers': long_headers}
+
+
+def compare(baseline, current, threshold=0.25, min_seconds=0.001):
+    regressions = []
+
+    for name, result in sorted(current['results'].items()):
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        for stage, seconds in sorted(result['stages'].items()):
+            base_seconds = base['stages'].get(stage)
+            if base_seconds is None or max(seconds, base_seconds) < min_seconds:
+                continue
+            if seconds > base_seconds * (1 + threshold):
+                regressions.append('{} {}: {:.4f}s -> {:.4f}s'.format(name, stage, base_seconds, seconds))
+        if 'peak_memory' in result and 'peak_memory' in base:
+            if result['peak_memory'] > base['peak_memory'] * (1 + threshold):
+                regressions.append('{} peak_memory: {} -> {} bytes'.format(name, base['peak_memory'], result['peak_memory']))
+        for layout, size in sorted(result.get('header_memory', {}).items()):
+            base_size = base.get('header_memory', {}).get(layout)
+            if base_size is not None and size > base_size * (1 + threshold):
+                regressions.append('{} header_memory {}: {} -> {} bytes'.format(name, layout, base_size, size))
+
+    for name, seconds in sorted(current.get('long_headers', {}).items()):
+        base_seconds = baseline.get('long_headers', {}).get(name)
+        if base_seconds is None or max(seconds, base_seconds) < min_seconds:
+            continue
+        if seconds > base_seconds * (1 + threshold):
+            regressions.append('long_headers {}: {:.4f}s -> {:.4f}s'.format(name, base_seconds, seconds))
+
+    return regressions
+
+
+def parse_command_line_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark mdtoc on generated documents')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_run = subparsers.add_parser('run', help='run benchmarks and write results as JSON')
+    parser_run.add_argument('--output', help='file to write results to (default: stdout)')
+    parser_run.add_argument('--sizes', help='document sizes in lines (default: 1000 100000 1000000)',
+                            type=int, nargs='+', default=SIZES)
+    parser_run.add_argument('--profiles', help='document profiles (default: all)',
+                            choices=PROFILES, nargs='+', default=PROFILES)
+    parser_run.add_argument('--repeat', help='timing repetitions, the best is kept (default: 3)',
+                            type=int, default=3)
+    parser_run.add_argument('--no-memory', help='skip peak memory measurement',
+                            dest='memory', action='store_false')
+
+    parser_compare = subparsers.add_parser('compare', help='fail if results regressed compared to a baseline')
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current')
+    parser_compare.add_argument('--threshold', help='allowed relative slowdown (default: 0.25)',
+                                type=float, default=0.25)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_command_line_arguments(argv)
+
+    if args.command == 'run':
+        results = run(args.sizes, args.profiles, args.repeat, args.memory)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,37 @@
 import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import difflib
+import errno
+import filecmp
+import fnmatch
+import functools
+import glob
+import hashlib
+import itertools
+import json
+import locale
+import os
+import posixpath
 import re
+import socket
+import sqlite3
+import stat
+import subprocess
 import sys
+import tempfile
+import time
+import unicodedata
+import urllib.parse
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Header structure
 # ================
@@ -12,129 +43,578 @@ import sys
 #                 Anchor tag
 #                          Name attribute
 
-class MdToc:
+HeaderRecord = collections.namedtuple('HeaderRecord', ['level', 'title', 'tag', 'line'])
+
+# Byte offsets of a header line in a buffer, end excludes the line ending
+ScannedHeader = collections.namedtuple('ScannedHeader', ['record', 'start', 'end'])
+
+
+class MdTocError(Exception):
+    pass
+
+
+class MissingContentsError(MdTocError):
+
+    def __init__(self):
+        super().__init__('Document does not contain header with name Contents')
+
+
+SLUG_DIALECTS = ['mdtoc', 'github', 'gitlab', 'kramdown']
+
+
+class SlugEngine:
+
+    MDTOC_TABLE = str.maketrans({'(': None,
+                                 ')': None,
+                                 '.': None,
+                                 "'": None,
+                                 ':': None,
+                                 '/': '-',
+                                 ' ': '-',
+                                 'å': 'a',
+                                 'ä': 'a',
+                                 'ö': 'o',
+                                 '&': 'and'})
+    SPACE_TABLE = str.maketrans({' ': '-'})
+
+    def __init__(self, dialect='mdtoc', cache_size=4096):
+        if dialect not in SLUG_DIALECTS:
+            raise ValueError('Unknown slug dialect: ' + dialect)
+        self.dialect = dialect
+        self.regexp_non_word = re.compile(r"[^\w\- ]")
+        self.regexp_hyphens = re.compile(r"-{2,}")
+        self.regexp_kramdown_leading = re.compile(r"^[^a-zA-Z]+")
+        self.regexp_kramdown_non_id = re.compile(r"[^a-zA-Z0-9 -]")
+        self.slugify = functools.lru_cache(maxsize=cache_size)(getattr(self, 'slugify_' + dialect))
+
+    def slugify_mdtoc(self, text):
+        return text.lower().translate(self.MDTOC_TABLE)
+
+    def slugify_github(self, text):
+        text = unicodedata.normalize('NFC', text.lower())
+        return self.regexp_non_word.sub('', text).translate(self.SPACE_TABLE)
+
+    def slugify_gitlab(self, text):
+        text = unicodedata.normalize('NFC', text.strip().lower())
+        text = self.regexp_non_word.sub('', text).translate(self.SPACE_TABLE)
+        text = self.regexp_hyphens.sub('-', text)
+        if text.isdigit():
+            text = 'anchor-' + text
+        return text
+
+    def slugify_kramdown(self, text):
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+        text = self.regexp_kramdown_leading.sub('', text)
+        text = self.regexp_kramdown_non_id.sub('', text)
+        text = text.translate(self.SPACE_TABLE).lower()
+        return text or 'section'
+
+
+class AnchorRegistry:
+
+    def __init__(self):
+        self.used = set()
+        self.next_suffix = {}
+
+    def __contains__(self, tag):
+        return tag in self.used
+
+    def __len__(self):
+        return len(self.used)
+
+    def add(self, tag):
+        self.used.add(tag)
+
+    def resolve(self, base_tag):
+        if base_tag not in self.used:
+            self.used.add(base_tag)
+            return base_tag
+        counter = self.next_suffix.get(base_tag, 2)
+        tag = base_tag + '-' + str(counter)
+        while tag in self.used:
+            counter += 1
+            tag = base_tag + '-' + str(counter)
+        self.used.add(tag)
+        self.next_suffix[base_tag] = counter + 1
+        return tag
+
+
+class HeaderView:
+
+    # Dict-like access to one header of a HeaderStore
+    COLUMNS = {'header': 'titles', 'level': 'levels', 'line': 'lines', 'tag': 'tags', 'new_tag': 'new_tags'}
+
+    __slots__ = ('columns', 'index')
+
+    def __init__(self, columns, index):
+        # columns maps keys to the columns of the store
+        self.columns = columns
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.columns[key][self.index]
+
+    def __setitem__(self, key, value):
+        self.columns[key][self.index] = value
+
+    def keys(self):
+        return self.COLUMNS.keys()
+
+
+class HeaderStore:
+
+    # Columnar list of headers for documents with millions of headers:
+    # levels and line numbers in arrays, titles and tags interned. It is
+    # indexed and iterated like a list of header dicts.
+
+    def __init__(self, records=()):
+        self.levels = array.array('B')
+        self.lines = array.array('I')
+        self.titles = []
+        self.tags = []
+        intern = sys.intern
+        for record in records:
+            self.levels.append(record.level)
+            self.lines.append(record.line)
+            self.titles.append(intern(record.title))
+            self.tags.append(None if record.tag is None else intern(record.tag))
+        self.new_tags = [None] * len(self.titles)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def columns(self):
+        return {key: getattr(self, name) for key, name in HeaderView.COLUMNS.items()}
+
+    def __iter__(self):
+        columns = self.columns()
+        return (HeaderView(columns, index) for index in range(len(self.titles)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            store = HeaderStore()
+            store.levels = self.levels[index]
+            store.lines = self.lines[index]
+            store.titles = self.titles[index]
+            store.tags = self.tags[index]
+            store.new_tags = self.new_tags[index]
+            return store
+        if index < 0:
+            index += len(self.titles)
+        if not 0 <= index < len(self.titles):
+            raise IndexError('header index out of range')
+        return HeaderView(self.columns(), index)
+
+
+class BlockLexer:
+
+    # Line kinds, UNDERLINE marks the previous line as a setext header
+    HEADER = 'header'
+    TEXT = 'text'
+    BLOCK = 'block'
+    UNDERLINE = 'underline'
+
+    # Lexer states, tuples so they can be compared and stored per line.
+    # PARAGRAPH_START follows a line starting a paragraph, the only kind of
+    # line that can be underlined as a setext header.
+    START = ('start',)
+    TEXT_STATE = ('text',)
+    PARAGRAPH_START = ('text', 'paragraph_start')
+    PARAGRAPH = ('text', 'paragraph')
+    FRONT_MATTER = ('front_matter',)
+
+    # States are compared by identity, so states passed between processes
+    # are mapped back to these
+    CANONICAL_STATES = {START: START,
+                        TEXT_STATE: TEXT_STATE,
+                        PARAGRAPH_START: PARAGRAPH_START,
+                        PARAGRAPH: PARAGRAPH,
+                        FRONT_MATTER: FRONT_MATTER}
+
+    # States after text lines that do not depend on the state before them
+    TEXT_GROUP_STATES = {'blank': TEXT_STATE, 'rule': TEXT_STATE, 'container': PARAGRAPH}
+
+    HTML_BLOCK_TAGS = ('address|article|aside|base|basefont|blockquote|body|caption|center|col|colgroup|dd|'
+                       'details|dialog|dir|div|dl|dt|fieldset|figcaption|figure|footer|form|frame|frameset|'
+                       'h[1-6]|head|header|hr|html|iframe|legend|li|link|main|menu|menuitem|nav|noframes|ol|'
+                       'optgroup|option|p|param|search|section|summary|table|tbody|td|tfoot|th|thead|title|tr|'
+                       'track|ul')
+
+    def __init__(self):
+        # The lookahead rejects most plain text lines at the first character
+        self.regexp_text = re.compile(r"(?=[ \t#`~{<=*_+>\d-]|$)"
+                                      r"(?:(?P<header>#{1,6} )"
+                                      r"|\{%-?\s*(?P<liquid>highlight|raw|comment)\b"
+                                      r"|(?P<blank>[ \t]*$)"
+                                      r"|(?P<indented> {4}|\t)"
+                                      r"|(?=(?P<indent> {0,3}))(?P=indent)"
+                                      r"(?:(?P<fence>`{3,}(?!.*`)|~{3,})"
+                                      r"|<(?i:(?P<html_raw>pre|script|style|textarea)(?:[\s>]|$)"
+                                      r"|(?P<html_comment>!--)"
+                                      r"|(?P<html_block>/?(?:" + self.HTML_BLOCK_TAGS + r")(?:[\s/>]|$)))"
+                                      r"|(?P<underline>(?:=+|-+)[ \t]*$)"
+                                      r"|(?P<rule>(?:(?:\*[ \t]*){3,}|(?:_[ \t]*){3,}|(?:-[ \t]*){3,})$)"
+                                      r"|(?P<container>(?:[-+*]|\d{1,9}[.)])(?:[ \t]|$)|>)))")
+        self.regexp_underline = re.compile(r" {0,3}(?:=+|-+)[ \t]*$")
+        self.regexp_fence_end = re.compile(r" {0,3}(`{3,}|~{3,})[ \t]*$")
+        self.regexp_liquid_end = re.compile(r"\{%-?\s*end(highlight|raw|comment)\b")
+        self.regexp_front_matter_end = re.compile(r"(?:---|\.\.\.)[ \t]*$")
+        self.regexp_html_end = {'html_raw': re.compile(r"</(?i:pre|script|style|textarea)>"),
+                                'html_comment': re.compile(r"-->"),
+                                'html_block': re.compile(r"[ \t]*$")}
+
+    def open_html(self, name, line, start):
+        # The line opening an HTML block may also close it
+        if name != 'html_block' and self.regexp_html_end[name].search(line, start):
+            return self.TEXT_STATE
+        return ('html', name)
+
+    def open_liquid(self, name, line, start):
+        # Like HTML, a one-line tag such as {% raw %}{{ x }}{% endraw %} closes the block
+        for match in self.regexp_liquid_end.finditer(line, start):
+            if match.group(1) == name:
+                return self.TEXT_STATE
+        return ('liquid', name)
+
+    def canonical_state(self, state):
+        return self.CANONICAL_STATES.get(state, state)
+
+    def classify(self, line, state):
+        # Returns the kind of line and the lexer state for the next line
+        if state is self.TEXT_STATE or state[0] == 'text':
+            match = self.regexp_text.match(line)
+            if match is None:
+                return self.TEXT, self.PARAGRAPH_START if state is self.TEXT_STATE else self.PARAGRAPH
+            name = match.lastgroup
+            if name == 'header':
+                return self.HEADER, self.TEXT_STATE
+            if name in self.TEXT_GROUP_STATES:
+                return self.TEXT, self.TEXT_GROUP_STATES[name]
+            if name == 'indented':
+                return self.TEXT, self.TEXT_STATE if state is self.TEXT_STATE else self.PARAGRAPH
+            if name == 'underline':
+                if state is self.PARAGRAPH_START:
+                    return self.UNDERLINE, self.TEXT_STATE
+                # A === line not following a paragraph starts one
+                if state is self.TEXT_STATE and '=' in line:
+                    return self.TEXT, self.PARAGRAPH_START
+                return self.TEXT, self.TEXT_STATE
+            if name == 'fence':
+                marks = match.group(name).lstrip(' ')
+                return self.BLOCK, ('fence', marks[0], len(marks))
+            if name == 'liquid':
+                return self.BLOCK, self.open_liquid(match.group(name), line, match.end())
+            return self.BLOCK, self.open_html(name, line, match.end())
+
+        kind = state[0]
+        if kind == 'fence':
+            match = self.regexp_fence_end.match(line)
+            if match is not None and match.group(1)[0] == state[1] and len(match.group(1)) >= state[2]:
+                return self.BLOCK, self.TEXT_STATE
+            return self.BLOCK, state
+        if kind == 'liquid':
+            match = self.regexp_liquid_end.match(line)
+            if match is not None and match.group(1) == state[1]:
+                return self.BLOCK, self.TEXT_STATE
+            return self.BLOCK, state
+        if kind == 'html':
+            if state[1] == 'html_block':
+                if self.regexp_html_end['html_block'].match(line):
+                    return self.TEXT, self.TEXT_STATE
+                return self.BLOCK, state
+            if self.regexp_html_end[state[1]].search(line):
+                return self.BLOCK, self.TEXT_STATE
+            return self.BLOCK, state
+        if kind == 'front_matter':
+            if self.regexp_front_matter_end.match(line):
+                return self.BLOCK, self.TEXT_STATE
+            return self.BLOCK, state
+        # START, only the first line may open front matter
+        if line.rstrip() == '---':
+            return self.BLOCK, self.FRONT_MATTER
+        return self.classify(line, self.TEXT_STATE)
+
+
+FileResult = collections.namedtuple('FileResult', ['filename', 'status', 'error', 'cache_entry', 'details', 'stats'])
+
+
+class Stats:
+
+    COUNTERS = ['files',
+                'files_cached',
+                'lines_scanned',
+                'headers_found',
+                'headers_skipped_in_blocks',
+                'slugs_generated',
+                'duplicate_collisions',
+                'bytes_read',
+                'bytes_written']
 
     def __init__(self):
-        self.regexp_header = re.compile(r"^#{1,6} ")
-        self.regexp_anchor_tag = re.compile(r"<a name=.{1,300}></a>$")
+        self.counters = collections.Counter()
+        self.timings = collections.Counter()
+        self.peak_memory = 0
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] += seconds
+
+    def update_peak_memory(self):
+        if resource is not None:
+            # ru_maxrss is reported in kilobytes on Linux
+            self.peak_memory = max(self.peak_memory, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    def merge(self, data):
+        self.counters.update(data['counters'])
+        self.timings.update(data['timings'])
+        self.peak_memory = max(self.peak_memory, data['peak_memory'])
+
+    def as_dict(self):
+        return {'counters': {name: self.counters[name] for name in self.COUNTERS},
+                'timings': dict(self.timings),
+                'peak_memory': self.peak_memory}
+
+    def format(self):
+        lines = ['{}: {}'.format(name.replace('_', ' '), self.counters[name]) for name in self.COUNTERS]
+        lines += ['time {}: {:.6f}s'.format(stage, seconds) for stage, seconds in self.timings.items()]
+        lines.append('peak memory: {} bytes'.format(self.peak_memory))
+        return '\n'.join(lines)
+
+
+class MdToc:
+
+    def __init__(self, slug_dialect='mdtoc', stats=None):
+        self.slug_engine = SlugEngine(slug_dialect)
+        self.lexer = BlockLexer()
+        self.stats = stats
+        self.regexp_header = re.compile(r"^(#{1,6}) ")
+        self.regexp_candidate_line = re.compile(rb"\n( {0,3}(?:[`~<][^\n]*|(?:=+|-+)[ \t]*\r?(?=\n|\Z))|[#{][^\n]*)")
+        self.regexp_first_candidate_line = re.compile(rb"( {0,3}(?:[`~<][^\n]*|(?:=+|-+)[ \t]*\r?(?=\n|\Z))|[#{][^\n]*)")
+        self.regexp_buffer_next_line = re.compile(rb"\r?\n[^\r\n]*")
+        self.regexp_front_matter_start = re.compile(rb"---[ \t]*\r?(?:\n|\Z)")
+        self.regexp_buffer_block_end = {'front_matter': re.compile(rb"\n(?:---|\.\.\.)[ \t]*\r?(?=\n|\Z)"),
+                                        'html_raw': re.compile(rb"</(?i:pre|script|style|textarea)>[^\n]*"),
+                                        'html_comment': re.compile(rb"-->[^\n]*"),
+                                        'html_block': re.compile(rb"\n[ \t]*\r?(?=\n|\Z)")}
+        # Compiled per liquid tag and fence by buffer_closing_line_end
+        self.regexp_buffer_closing_line = {}
+        self.regexp_link = re.compile(r"\]\(\s*<?([^)\s>]+)>?(?:\s+[\"'(][^)]*)?\)|^ {0,3}\[[^\]]+\]:\s*<?([^\s>]+)")
+        self.regexp_code_span = re.compile(r"(`+).*?\1")
         self.HEADER_LEVEL_SPACES_INDENT = 4
         self.ANCHOR_TAG_PREFIX = '<a name="'
         self.ANCHOR_TAG_POSTFIX = '"></a>'
+        self.ANCHOR_TAG_START = '<a name='
+        self.ANCHOR_TAG_END = '></a>'
         self.TOC_HEADER = "Contents"
 
-    def is_header(self, line):
-        result = self.regexp_header.match(line)
-        if result is None:
-            return False
-        else:
+    def is_header(self, line, next_line=None):
+        # next_line is needed to recognise setext headers
+        if self.regexp_header.match(line) is not None:
             return True
+        if next_line is None:
+            return False
+        _, state = self.lexer.classify(line, self.lexer.TEXT_STATE)
+        return state is self.lexer.PARAGRAPH_START and self.lexer.classify(next_line, state)[0] is self.lexer.UNDERLINE
 
     def compose_name_attribute(self, header_text):
-        name_attribute = header_text.lower()
-        name_attribute = name_attribute.replace('(', '')
-        name_attribute = name_attribute.replace(')', '')
-        name_attribute = name_attribute.replace('.', '')
-        name_attribute = name_attribute.replace("'", "")
-        name_attribute = name_attribute.replace('/', '-')
-        name_attribute = name_attribute.replace(' ', '-')
-        name_attribute = name_attribute.replace('å', 'a')
-        name_attribute = name_attribute.replace('ä', 'a')
-        name_attribute = name_attribute.replace('ö', 'o')
-        name_attribute = name_attribute.replace('&', 'and')
-        name_attribute = name_attribute.replace(':', '')
-        return name_attribute 
+        return self.slug_engine.slugify(header_text)
 
     def compose_anchor_tag(self, anchor_name):
         return self.ANCHOR_TAG_PREFIX + anchor_name + self.ANCHOR_TAG_POSTFIX
 
+    def split_anchor_tag(self, text):
+        # Returns the text before the anchor tag and the anchor tag, None if
+        # missing. The anchor tag runs from the leftmost <a name= to a
+        # closing tag at the end of the text. Both are found with one suffix
+        # check and one bounded find, so the cost is linear in the length of
+        # the text for any anchor length.
+        if text.endswith(self.ANCHOR_TAG_END):
+            # The name attribute must not be empty
+            anchor_start = text.find(self.ANCHOR_TAG_START, 0, len(text) - len(self.ANCHOR_TAG_END) - 1)
+            if anchor_start != -1:
+                return text[:anchor_start], text[anchor_start:]
+        return text, None
+
+    def atx_title_end(self, line, start):
+        # End of the title of an atx header starting at start, which is
+        # before the closing sequence of a closed header like ## Title ##
+        content = line[start:].rstrip(' \t')
+        if not content.endswith('#'):
+            return len(line)
+        content = content.rstrip('#')
+        # Without a title, like # #, the pounds are kept as the title
+        if not content.strip() or content[-1] not in ' \t':
+            return len(line)
+        return start + len(content.rstrip(' \t'))
+
+    def split_header_line(self, line):
+        # Returns pounds, title and anchor tag (None if missing) of an atx
+        # header line, or None if the line is not one
+        match = self.regexp_header.match(line)
+        if match is None:
+            return None
+        start = match.end()
+        end = self.atx_title_end(line, start)
+        return (match.group(1),) + self.split_anchor_tag(line[start:end])
+
     def parse_header_elements(self, line):
-        header_elements = []
+        pounds, header_title, anchor_tag = self.split_header_line(line)
+        return [pounds, header_title, anchor_tag or '']
+
+    def record_from_elements(self, elements, line_number):
+        pounds, header_title, anchor_tag = elements
+        tag = anchor_tag.split('"')[1] if anchor_tag else None
+        return HeaderRecord(len(pounds), header_title, tag, line_number)
 
-        match_pounds = self.regexp_header.search(line)
-        match_tag = self.regexp_anchor_tag.search(line)
+    def record_from_setext(self, line, underline, line_number):
+        header_title, anchor_tag = self.split_anchor_tag(line.strip())
+        tag = anchor_tag.split('"')[1] if anchor_tag else None
+        return HeaderRecord(1 if underline.lstrip()[0] == '=' else 2, header_title, tag, line_number)
 
-        pounds = match_pounds.group()
-        pounds = pounds.rstrip(' ') 
+    def tokenize_header(self, line, line_number=None, underline=None):
+        # A setext header is tokenized from its line and underline
+        if underline is not None:
+            return self.record_from_setext(line, underline, line_number)
+        elements = self.split_header_line(line)
+        if elements is None:
+            return None
+        return self.record_from_elements(elements, line_number)
 
-        title_start_pos = match_pounds.end()
-        title_end_pos = match_tag.start() if match_tag else len(line) 
-        header_title = line[title_start_pos:title_end_pos]
+    def tokenize_headers(self, lines):
+        return list(self.iter_header_records(lines))
 
-        anchor_tag = match_tag.group() if match_tag else ''
+    def scan_header_records(self, lines, state=None, first_line=1, previous=None):
+        # Returns the header records of lines scanned from state, and the
+        # lexer state after them
+        records = []
+        scan = self.iter_header_records(lines, state, first_line, previous)
+        while True:
+            try:
+                records.append(next(scan))
+            except StopIteration as stop:
+                return records, stop.value
 
-        header_elements.append(pounds)
-        header_elements.append(header_title)
-        header_elements.append(anchor_tag)
+    def iter_header_records(self, lines, state=None, first_line=1, previous=None):
+        # Scanning can start from any lexer state, previous is the line before
+        # lines. Returns the lexer state after the last line when done.
+        found = 0
+        classify = self.lexer.classify
+        HEADER = self.lexer.HEADER
+        BLOCK = self.lexer.BLOCK
+        UNDERLINE = self.lexer.UNDERLINE
+        state = self.lexer.canonical_state(state or self.lexer.START)
+        split_header_line = self.split_header_line
+        match_header = self.regexp_header.match
+        count_skipped = self.stats is not None
+        skipped = 0
+        line_number = first_line - 1
 
-        return header_elements
-        
+        text_state = self.lexer.TEXT_STATE
+        paragraph_start = self.lexer.PARAGRAPH_START
+        paragraph = self.lexer.PARAGRAPH
+        text_group_states = self.lexer.TEXT_GROUP_STATES
+        match_text = self.lexer.regexp_text.match
+
+        for line_number, line in enumerate(lines, first_line):
+            # Fast path for plain text, blank and list lines, the vast
+            # majority, with the same state changes as classify
+            if state is text_state or state is paragraph_start or state is paragraph:
+                match = match_text(line)
+                if match is None:
+                    state = paragraph_start if state is text_state else paragraph
+                    previous = line
+                    continue
+                if match.lastgroup in text_group_states:
+                    state = text_group_states[match.lastgroup]
+                    continue
+            kind, state = classify(line, state)
+            if kind is HEADER:
+                found += 1
+                yield self.record_from_elements(split_header_line(line), line_number)
+            elif kind is UNDERLINE:
+                found += 1
+                yield self.record_from_setext(previous, line, line_number - 1)
+            elif count_skipped and kind is BLOCK and match_header(line) is not None:
+                skipped += 1
+            previous = line
+
+        if self.stats is not None:
+            self.stats.count('lines_scanned', line_number - first_line + 1)
+            self.stats.count('headers_found', found)
+            self.stats.count('headers_skipped_in_blocks', skipped)
+
+        return state
 
     def parse_header_level(self, line):
-        header_elements = self.parse_header_elements(line)
-        pounds = header_elements[0]
-        level = pounds.count('#')
-        return level
+        return self.tokenize_header(line).level
 
     def parse_header_title(self, line):
-        header_elements = self.parse_header_elements(line)
-        header_title = header_elements[1]
-        return header_title
+        return self.tokenize_header(line).title
 
     def parse_anchor_tag_name(self, line):
-        header_elements = self.parse_header_elements(line)
-        anchor_tag = header_elements[2]
-        if anchor_tag == '':
-            return None
-        anchor_tag_split = anchor_tag.split('"')
-        anchor_tag_name = anchor_tag_split[1]
-        return anchor_tag_name
+        return self.tokenize_header(line).tag
+
+    def header_from_record(self, record):
+        return {'header': record.title,
+                'level' : record.level,
+                'line'  : record.line,
+                'tag'   : record.tag}
 
     def parse_header(self, line, line_number):
-        header = {'header': self.parse_header_title(line),
-                  'level' : self.parse_header_level(line),
-                  'line'  : line_number,
-                  'tag'   : self.parse_anchor_tag_name(line)}
-        return header
+        return self.header_from_record(self.tokenize_header(line, line_number))
 
     def parse_headers(self, lines):
-        toc = []
-        code_highlight_section = False
+        return [self.header_from_record(record) for record in self.tokenize_headers(lines)]
 
-        for index, line in enumerate(lines):
-            line_number = index + 1
+    def parse_header_store(self, lines):
+        return HeaderStore(self.iter_header_records(lines))
 
-            if line.startswith("{% highlight"):
-                code_highlight_section = True
+    def parse_links(self, lines):
+        # Returns (line number, target) for inline links and link reference
+        # definitions outside code and HTML blocks
+        links = []
+        classify = self.lexer.classify
+        BLOCK = self.lexer.BLOCK
+        state = self.lexer.START
+        match_text = self.lexer.regexp_text.match
 
-            if not code_highlight_section and self.is_header(line):
-                header = self.parse_header(line, line_number)
-                toc.append(header)
+        for line_number, line in enumerate(lines, 1):
+            if state[0] != 'text' or match_text(line) is not None:
+                kind, state = classify(line, state)
+                if kind is BLOCK:
+                    continue
+            if '](' not in line and ']:' not in line:
+                continue
+            for match in self.regexp_link.finditer(self.regexp_code_span.sub('', line)):
+                links.append((line_number, match.group(1) or match.group(2)))
 
-            if line.startswith("{% endhighlight %}"):
-                code_highlight_section = False
-
-        return toc
+        return links
 
     def generate_non_duplicate_name_attribute(self, base_tag, tags):
-        tag = base_tag
-        counter = 2
-        while tag in tags:
-            tag = base_tag + '-' + str(counter)
-            counter += 1
-        return tag
+        return tags.resolve(base_tag)
 
     def generate_tags(self, headers):
-        tags = []
+        tags = AnchorRegistry()
+        slugs = 0
+        collisions = 0
 
         for header in headers:
             header['new_tag'] = None
             if header['tag'] is None:
                 tag = self.compose_name_attribute(header['header'])
-                tag = self.generate_non_duplicate_name_attribute(tag, tags)
-                header['new_tag'] = tag
+                header['new_tag'] = self.generate_non_duplicate_name_attribute(tag, tags)
+                slugs += 1
+                if header['new_tag'] != tag:
+                    collisions += 1
             else:
-                tag = header['tag']
-            tags.append(tag)
+                tags.add(header['tag'])
+
+        if self.stats is not None:
+            self.stats.count('slugs_generated', slugs)
+            self.stats.count('duplicate_collisions', collisions)
 
         return headers
 
@@ -152,73 +632,1079 @@ class MdToc:
         header_level_min = self.header_level_min(headers_in_toc)
 
         for header in headers_in_toc:
-            toc_line = ""
             spaces = self.HEADER_LEVEL_SPACES_INDENT * (header['level'] - header_level_min)
-            while len(toc_line) < spaces:
-                toc_line += ' '
-            toc_line += '*'
-            toc_line += ' ['
-            toc_line += header['header'].rstrip()
-            toc_line += '](#'
-            if header['tag'] is None:
-                toc_line += header['new_tag'].rstrip()
-            else:
-                toc_line += header['tag'].rstrip()
-            toc_line += ')'
-            toc.append(toc_line)
+            tag = header['new_tag'] if header['tag'] is None else header['tag']
+            toc.append(' ' * spaces + '* [' + header['header'].rstrip() + '](#' + tag.rstrip() + ')')
 
         return toc
 
 
+    def insert_anchor_tag(self, line, anchor_name):
+        # The anchor tag goes before the closing sequence of a closed atx
+        # header and at the end of other header lines
+        line = line.rstrip()
+        if not line.endswith('#'):
+            return line + self.compose_anchor_tag(anchor_name)
+        match = self.regexp_header.match(line)
+        end = len(line) if match is None else self.atx_title_end(line, match.end())
+        return line[:end] + self.compose_anchor_tag(anchor_name) + line[end:]
+
+    def tag_header_line(self, line, header):
+        if header['tag'] is None:
+            return self.insert_anchor_tag(line, header['new_tag'])
+        return line.rstrip()
+
     def add_anchor_tags(self, lines, headers):
-        output_lines = lines
+        output_lines = list(lines)
 
         for header in headers:
-            output_line = output_lines[header['line']-1].rstrip()
-            if header['tag'] is None:
-                output_line += self.compose_anchor_tag(header['new_tag'])
-            output_lines[header['line']-1] = output_line
+            output_lines[header['line']-1] = self.tag_header_line(output_lines[header['line']-1], header)
 
         return output_lines
 
 
     def add_toc(self, lines, skip_headers=0):
-        output_lines = []
+        try:
+            return self.rewrite_lines(lines, skip_headers)
+        except MissingContentsError as e:
+            print('ERROR: ' + str(e))
+            sys.exit(1)
 
-        headers = self.parse_headers(lines)
-        headers_with_tags = self.generate_tags(headers)
-        toc = self.generate_toc(headers_with_tags, skip_headers)
-        content_with_tags = self.add_anchor_tags(lines, headers_with_tags)
-        output_lines = self.insert_toc(content_with_tags, toc)
+    def run_stage(self, stage, function, *args):
+        if self.stats is None:
+            return function(*args)
+        start = time.perf_counter()
+        result = function(*args)
+        self.stats.add_time(stage, time.perf_counter() - start)
+        return result
 
-        return output_lines
+    def rewrite_lines(self, lines, skip_headers=0, headers=None):
+        if headers is None:
+            headers = self.run_stage('parse_headers', self.parse_header_store, lines)
+        headers_with_tags = self.run_stage('generate_tags', self.generate_tags, headers)
+        toc = self.run_stage('generate_toc', self.generate_toc, headers_with_tags, skip_headers)
+        return self.run_stage('assemble_lines', self.assemble_lines, lines, headers_with_tags, toc)
+
+    def iter_output_chunks(self, lines, headers, toc):
+        # Yields the output as lists of lines: untouched slices of the input
+        # between headers, tagged header lines and the table of contents,
+        # which replaces everything up to the header after Contents.
+        position = 0
+
+        for index, header in enumerate(headers):
+            line_index = header['line'] - 1
+            yield lines[position:line_index]
+            yield [self.tag_header_line(lines[line_index], header)]
+            position = line_index + 1
+            if header['header'] == self.TOC_HEADER:
+                if self.regexp_header.match(lines[line_index]) is None:
+                    # Keep the underline of a setext header
+                    yield lines[position:position + 1]
+                yield [''] + toc + ['']
+                position = headers[index + 1]['line'] - 1 if index + 1 < len(headers) else len(lines)
+
+        yield lines[position:]
+
+    def assemble_lines(self, lines, headers, toc):
+        if not any(header['header'] == self.TOC_HEADER for header in headers):
+            raise MissingContentsError()
 
-    def insert_toc(self, lines_with_tags, toc):
         output = []
+        for chunk in self.iter_output_chunks(lines, headers, toc):
+            output += chunk
+        return output
+
+    def iter_splice_lines(self, lines, headers, toc):
+        # Streaming counterpart of iter_output_chunks for iterables of lines
+        headers_by_line = {header['line']: header for header in headers}
+        section_ends = {}
+        for index, header in enumerate(headers):
+            if header['header'] == self.TOC_HEADER:
+                section_ends[header['line']] = headers[index + 1]['line'] if index + 1 < len(headers) else None
+        skip_before = 0
+        toc_line = None
+        section_end = None
+
+        for line_number, line in enumerate(lines, 1):
+            if skip_before is None or line_number < skip_before:
+                continue
+            header = headers_by_line.get(line_number)
+            if header is None:
+                yield line
+            else:
+                yield self.tag_header_line(line, header)
+            if line_number in section_ends:
+                # After the underline of a setext header
+                toc_line = line_number if self.regexp_header.match(line) else line_number + 1
+                section_end = section_ends[line_number]
+            if line_number == toc_line:
+                yield ''
+                yield from toc
+                yield ''
+                skip_before = section_end
+
+    def iter_insert_toc(self, lines_with_tags, toc):
         insert_toc = False
         insert_toc_done = False
+        toc_after_underline = False
+        classify = self.lexer.classify
+        UNDERLINE = self.lexer.UNDERLINE
+        state = self.lexer.START
+        line = kind = None
+
+        # Each line is handled once the next line is classified, as setext
+        # headers are only known from their underline
+        for next_line in itertools.chain(lines_with_tags, [None]):
+            next_kind = None
+            if next_line is not None:
+                next_kind, state = classify(next_line, state)
+            if line is None:
+                line, kind = next_line, next_kind
+                continue
 
-        for line in lines_with_tags:
-            if self.is_header(line):
-                if self.TOC_HEADER == self.parse_header_title(line):
+            if kind is self.lexer.HEADER or next_kind is UNDERLINE:
+                underline = next_line if next_kind is UNDERLINE else None
+                if self.TOC_HEADER == self.tokenize_header(line, underline=underline).title:
                     insert_toc = True
-                    output.append(line)
-                    output.append('')
-                    output += toc
-                    output.append('')
+                    yield line
+                    if underline is None:
+                        yield ''
+                        yield from toc
+                        yield ''
+                    else:
+                        toc_after_underline = True
                     insert_toc_done = True
                 else:
                     insert_toc = False
+            elif kind is UNDERLINE and toc_after_underline:
+                toc_after_underline = False
+                yield line
+                yield ''
+                yield from toc
+                yield ''
 
             if not insert_toc:
-                output.append(line)
+                yield line
+            line, kind = next_line, next_kind
 
         if not insert_toc_done:
-            print('ERROR: Document does not contain header with name Contents')
+            raise MissingContentsError()
+
+    def insert_toc(self, lines_with_tags, toc):
+        output = []
+
+        try:
+            for line in self.iter_insert_toc(lines_with_tags, toc):
+                output.append(line)
+        except MissingContentsError as e:
+            print('ERROR: ' + str(e))
             sys.exit(1)
 
         return output
 
+    def check_lines(self, lines, skip_headers=0):
+        # Returns (line number, reason) for the first line add_toc would
+        # change, or None when anchors and table of contents are up to date.
+        headers = self.parse_header_store(lines)
+
+        for header in headers:
+            if header['tag'] is None:
+                return header['line'], 'header has no anchor tag'
+
+        contents_headers = [header for header in headers if header['header'] == self.TOC_HEADER]
+        if not contents_headers:
+            raise MissingContentsError()
+
+        toc = self.generate_toc(self.generate_tags(headers), skip_headers)
+        expected_section = [''] + toc + ['']
+        header_lines = set(header['line'] for header in headers)
+
+        for contents_header in contents_headers:
+            line_number = contents_header['line']
+            if self.regexp_header.match(lines[line_number - 1]) is None:
+                # The section starts after the underline of a setext header
+                line_number += 1
+            for expected_line in expected_section:
+                if line_number >= len(lines) or lines[line_number] != expected_line or line_number + 1 in header_lines:
+                    return line_number + 1, 'table of contents is out of date'
+                line_number += 1
+            if line_number < len(lines) and line_number + 1 not in header_lines:
+                return line_number + 1, 'table of contents is out of date'
+
+        return None
+
+    def iter_add_toc(self, read_lines, skip_headers=0):
+        # read_lines is called once per pass and must return a fresh
+        # iterator over the document lines without trailing newlines.
+        headers = self.run_stage('parse_headers', self.parse_header_store, read_lines())
+        headers = self.run_stage('generate_tags', self.generate_tags, headers)
+        if not any(header['header'] == self.TOC_HEADER for header in headers):
+            raise MissingContentsError()
+        toc = self.run_stage('generate_toc', self.generate_toc, headers, skip_headers)
+        return self.iter_splice_lines(read_lines(), headers, toc)
+
+    def iter_buffer_candidates(self, view, start=0):
+        # Yields (start, end) offsets of lines that may be headers or open or
+        # close a block, found by bulk searches instead of iterating over
+        # every line
+        matches = self.regexp_candidate_line.finditer(view, start)
+        first = self.regexp_first_candidate_line.match(view) if start == 0 else None
+        if first is not None:
+            matches = itertools.chain([first], matches)
+
+        for match in matches:
+            line_start, line_end = match.span(1)
+            if line_end > line_start and view[line_end - 1] == 13:
+                line_end -= 1
+            yield line_start, line_end
+
+    def buffer_block_end(self, view, block, start):
+        # Blocks whose end can not be told from candidate lines are skipped
+        # with a direct search
+        match = self.regexp_buffer_block_end[block].search(view, start)
+        return len(view) if match is None else match.end()
+
+    def buffer_closing_line_end(self, view, state, start):
+        # End of the line closing the liquid or fenced block of state,
+        # found with one search instead of classifying each line inside
+        pattern = self.regexp_buffer_closing_line.get(state)
+        if pattern is None:
+            if state[0] == 'liquid':
+                pattern = rb"\n\{%-?[^\S\n]*end" + state[1].encode('ascii') + rb"\b[^\n]*"
+            else:
+                pattern = rb"\n {0,3}" + re.escape(state[1].encode('ascii')) + rb"{%d,}[ \t]*\r?(?=\n|\Z)" % state[2]
+            pattern = self.regexp_buffer_closing_line[state] = re.compile(pattern)
+        match = pattern.search(view, start)
+        return len(view) if match is None else match.end()
+
+    def buffer_previous_line(self, view, rfind, start):
+        # Offsets of the line before the line starting at start
+        line_end = start - 1
+        line_start = rfind(b'\n', 0, line_end) + 1
+        if line_end > line_start and view[line_end - 1] == 13:
+            line_end -= 1
+        return line_start, line_end
+
+    def buffer_text_state(self, view, rfind, start, text_start, encoding):
+        # Lexer state before the line starting at start, in text that began
+        # at text_start. Whether the previous line starts a paragraph
+        # depends on the line before it, and indented lines and === lines
+        # depend on the state before them, so the walk back continues over
+        # those.
+        lexer = self.lexer
+        lines = []
+        while start > text_start:
+            start, end = self.buffer_previous_line(view, rfind, start)
+            if start < text_start:
+                break
+            line = bytes(view[start:end]).decode(encoding)
+            lines.append(line)
+            match = lexer.regexp_text.match(line)
+            if len(lines) > 1 and (match is None or not (match.lastgroup == 'indented' or
+                                                         match.lastgroup == 'underline' and '=' in line)):
+                break
+
+        state = lexer.TEXT_STATE
+        for line in reversed(lines):
+            _, state = lexer.classify(line, state)
+        return state
+
+    def scan_buffer(self, buffer, encoding='utf-8'):
+        view = memoryview(buffer).cast('B')
+        count_newlines = buffer.count if hasattr(buffer, 'count') else lambda _, a, b: bytes(view[a:b]).count(b'\n')
+        if hasattr(buffer, 'rfind'):
+            rfind = buffer.rfind
+        else:
+            def rfind(sub, start, end):
+                # Search back in growing windows, lines are short
+                window = 256
+                while True:
+                    low = max(start, end - window)
+                    found = bytes(view[low:end]).rfind(sub)
+                    if found != -1 or low == start:
+                        return found if found == -1 else low + found
+                    window *= 4
+        lexer = self.lexer
+        split_header_line = self.split_header_line
+        record_from_elements = self.record_from_elements
+        regexp_underline = lexer.regexp_underline
+        text_state = lexer.TEXT_STATE
+        scanned = []
+        state = lexer.TEXT_STATE
+        line_number = 1
+        position = 0
+
+        search_start = 0
+        if self.regexp_front_matter_start.match(view):
+            search_start = self.buffer_block_end(view, 'front_matter', 0)
+        # Start of the text following the last block
+        text_start = search_start
+        candidates = self.iter_buffer_candidates(view, search_start)
+
+        while candidates is not None:
+            jump = None
+            for start, end in candidates:
+                line_number += count_newlines(b'\n', position, start)
+                position = start
+                line = str(view[start:end], encoding)
+                if state[0] == 'text':
+                    # Fast path for atx headers, the most common candidates
+                    elements = split_header_line(line)
+                    if elements is not None:
+                        scanned.append(ScannedHeader(record_from_elements(elements, line_number), start, end))
+                        state = text_state
+                        continue
+                    if regexp_underline.match(line):
+                        state = self.buffer_text_state(view, rfind, start, text_start, encoding)
+                kind, state = lexer.classify(line, state)
+                if kind is lexer.HEADER:
+                    scanned.append(ScannedHeader(self.tokenize_header(line, line_number), start, end))
+                elif kind is lexer.UNDERLINE:
+                    header_start, header_end = self.buffer_previous_line(view, rfind, start)
+                    header_line = bytes(view[header_start:header_end]).decode(encoding)
+                    record = self.tokenize_header(header_line, line_number - 1, line)
+                    scanned.append(ScannedHeader(record, header_start, header_end))
+                elif state[0] == 'html':
+                    jump = self.buffer_block_end(view, state[1], end)
+                    state = lexer.TEXT_STATE
+                    text_start = jump
+                    break
+                elif state[0] == 'liquid' or state[0] == 'fence':
+                    jump = self.buffer_closing_line_end(view, state, end)
+                    state = lexer.TEXT_STATE
+                    text_start = jump
+                    break
+                elif kind is lexer.BLOCK and state[0] == 'text':
+                    text_start = end
+            candidates = None if jump is None else self.iter_buffer_candidates(view, jump)
+
+        return scanned
+
+    def iter_splice_buffer(self, buffer, skip_headers=0, encoding='utf-8'):
+        # Yields chunks of the rewritten document. Only header lines and
+        # the Contents section are produced anew, the rest are slices of
+        # the original buffer.
+        view = memoryview(buffer).cast('B')
+        scanned = self.scan_buffer(buffer, encoding)
+        headers = self.generate_tags(HeaderStore(item.record for item in scanned))
+        if not any(header['header'] == self.TOC_HEADER for header in headers):
+            raise MissingContentsError()
+        toc = self.generate_toc(headers, skip_headers)
+        position = 0
+
+        for index, (item, header) in enumerate(zip(scanned, headers)):
+            line = self.tag_header_line(bytes(view[item.start:item.end]).decode(encoding), header)
+            yield view[position:item.start]
+            yield line.encode(encoding)
+            position = item.end
+
+            if header['header'] == self.TOC_HEADER:
+                if self.regexp_header.match(line) is None:
+                    # Keep the underline of a setext header
+                    position = self.regexp_buffer_next_line.match(view, item.end).end()
+                    yield view[item.end:position]
+                newline = b'\r\n' if bytes(view[position:position + 2]) == b'\r\n' else b'\n'
+                yield newline.join([b''] + [b''] + [toc_line.encode(encoding) for toc_line in toc] + [b''] + [b''])
+                position = scanned[index + 1].start if index + 1 < len(scanned) else len(view)
+
+        yield view[position:]
+
+
+
+class Document:
+
+    def __init__(self, lines, mt=None):
+        self.mt = mt or MdToc()
+        self.lines = []
+        self.states = [self.mt.lexer.START]
+        self.records = []
+        self.record_lines = []
+        self.edit(0, 0, lines)
+
+    def scan_line(self, index, state):
+        # Looks ahead at the next line for setext headers
+        lexer = self.mt.lexer
+        line = self.lines[index]
+        kind, state = lexer.classify(line, state)
+        if kind is lexer.HEADER:
+            return self.mt.tokenize_header(line, index + 1), state
+        if state is lexer.PARAGRAPH_START and index + 1 < len(self.lines):
+            underline = self.lines[index + 1]
+            if lexer.classify(underline, state)[0] is lexer.UNDERLINE:
+                return self.mt.tokenize_header(line, index + 1, underline), state
+        return None, state
+
+    def edit(self, start, end, new_lines):
+        # Replace self.lines[start:end] with new_lines and reparse from
+        # the line before start, which may be underlined by the first new
+        # line, until the lexer state matches the state before the edit.
+        if not 0 <= start <= end <= len(self.lines):
+            raise IndexError('edit range out of bounds')
+        new_lines = list(new_lines)
+        delta = len(new_lines) - (end - start)
+        old_states = self.states
+        self.lines[start:end] = new_lines
+        stop = start + len(new_lines)
+        start = max(start - 1, 0)
+
+        state = old_states[start]
+        new_states = []
+        new_records = []
+        index = start
+        while index < len(self.lines):
+            if index >= stop and state == old_states[index - delta]:
+                break
+            record, state = self.scan_line(index, state)
+            if record is not None:
+                new_records.append(record)
+            new_states.append(state)
+            index += 1
+
+        old_index = index - delta
+        self.states[start + 1:old_index + 1] = new_states
+
+        low = bisect.bisect_left(self.record_lines, start + 1)
+        high = bisect.bisect_left(self.record_lines, old_index + 1)
+        tail = [record._replace(line=record.line + delta) for record in self.records[high:]] if delta else self.records[high:]
+        self.records[low:] = new_records + tail
+        self.record_lines[low:] = [record.line for record in new_records] + [record.line for record in tail]
+
+        return index - start
+
+    def replace(self, lines):
+        # Edit to lines, replacing the range between the lines both have in
+        # common at the start and at the end
+        old_lines = self.lines
+        limit = min(len(old_lines), len(lines))
+        prefix = 0
+        while prefix < limit and old_lines[prefix] == lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and old_lines[-1 - suffix] == lines[-1 - suffix]:
+            suffix += 1
+        return self.edit(prefix, len(old_lines) - suffix, lines[prefix:len(lines) - suffix])
+
+    def headers(self):
+        return self.mt.generate_tags([self.mt.header_from_record(record) for record in self.records])
+
+    def toc(self, skip_headers=0):
+        return self.mt.generate_toc(self.headers(), skip_headers)
+
+    def rewrite(self, skip_headers=0):
+        return self.mt.rewrite_lines(self.lines, skip_headers, self.headers())
+
+
+engines = {}
+
+# Files are only scanned in parallel in chunks of at least this many characters
+PARALLEL_SCAN_MIN_CHUNK_SIZE = 4 * 1024 * 1024
+PARALLEL_SCAN_CHECKPOINT_LINES = 4096
+
+
+def get_engine(slug_dialect='mdtoc'):
+    # One engine per dialect and process, so the slug cache is shared
+    # between all files handled by a worker.
+    if slug_dialect not in engines:
+        engines[slug_dialect] = MdToc(slug_dialect)
+    return engines[slug_dialect]
+
+
+def read_file_lines(f):
+    f.seek(0)
+    for line in f:
+        yield line.rstrip('\n')
+
+
+def split_lines(text):
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def join_lines(lines):
+    return ''.join(line + '\n' for line in lines)
+
+
+def add_toc_stream(mt, f_in, f_out, skip_headers=0):
+    for line in mt.iter_add_toc(lambda: read_file_lines(f_in), skip_headers):
+        f_out.write(line + '\n')
+
+
+def detect_newline(newlines):
+    # newlines is the newlines attribute of a text file after reading it
+    if newlines is None:
+        return '\n'
+    if isinstance(newlines, str):
+        return newlines
+    return '\r\n' if '\r\n' in newlines else newlines[0]
+
+
+def check_writable(filename):
+    if os.path.exists(filename) and not os.access(filename, os.W_OK):
+        raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), filename)
+
+
+@contextlib.contextmanager
+def temporary_output(filename, newline='\n'):
+    # Symbolic links are followed, so the file they point to is replaced.
+    # Like writing in place, replacing a read-only file is refused.
+    filename = os.path.realpath(filename)
+    check_writable(filename)
+    directory = os.path.dirname(os.path.abspath(filename))
+    prefix = '.' + os.path.basename(filename) + '.'
+    f = tempfile.NamedTemporaryFile('w', dir=directory, prefix=prefix, suffix='.tmp', delete=False, newline=newline)
+    try:
+        with f:
+            yield f
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def replace_with_temporary(temporary_filename, filename):
+    filename = os.path.realpath(filename)
+    try:
+        os.chmod(temporary_filename, os.stat(filename).st_mode & 0o7777)
+    except FileNotFoundError:
+        pass
+    os.replace(temporary_filename, filename)
+
+
+def common_prefix_length(a, b, block_size=64 * 1024):
+    # Compares whole blocks first, then the characters of the first block
+    # that differs
+    length = min(len(a), len(b))
+    position = 0
+    while position < length and a[position:position + block_size] == b[position:position + block_size]:
+        position += block_size
+    end = min(position + block_size, length)
+    while position < end and a[position] == b[position]:
+        position += 1
+    return min(position, length)
+
+
+def encode_text(text, newline='\n', encoding=None):
+    if newline != '\n':
+        text = text.replace('\n', newline)
+    return text.encode(encoding or locale.getpreferredencoding(False))
+
+
+def write_file_tail(filename, text, original_text, newline='\n', original_mtime_ns=None):
+    # Overwrites the file from the first character where text differs from
+    # original_text and truncates it. Returns False without writing if the
+    # size of the file does not match original_text, or its modification
+    # time does not match original_mtime_ns, taken before it was read.
+    start = common_prefix_length(text, original_text)
+    offset = len(encode_text(original_text[:start], newline))
+    original_size = offset + len(encode_text(original_text[start:], newline))
+    with open(filename, 'r+b') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size != original_size or original_mtime_ns is not None and stat.st_mtime_ns != original_mtime_ns:
+            return False
+        f.seek(offset)
+        f.write(encode_text(text[start:], newline))
+        f.truncate()
+    return True
+
+
+def write_file(filename, text, original_text=None, newline='\n', in_place=False, original_mtime_ns=None):
+    # With in_place, only the changed end of the file is rewritten, falling
+    # back to replacing the whole file if it was changed since it was read
+    if text == original_text:
+        return False
+
+    if in_place and original_text is not None:
+        check_writable(filename)
+        if write_file_tail(filename, text, original_text, newline, original_mtime_ns):
+            return True
+
+    with temporary_output(filename, newline) as f_out:
+        f_out.write(text)
+    replace_with_temporary(f_out.name, filename)
+    return True
+
+
+def add_toc_stream_file(mt, filename, skip_headers=0):
+    with open(filename, 'r') as f_in:
+        output_lines = mt.iter_add_toc(lambda: read_file_lines(f_in), skip_headers)
+        with temporary_output(filename, detect_newline(f_in.newlines)) as f_out:
+            for line in output_lines:
+                f_out.write(line + '\n')
+
+    if filecmp.cmp(f_out.name, filename, shallow=False):
+        os.unlink(f_out.name)
+        return False
+    replace_with_temporary(f_out.name, filename)
+    return True
+
+
+def split_text_chunks(text, count):
+    # Splits text after newlines into at most count chunks of similar size
+    chunks = []
+    start = 0
+    for index in range(1, count):
+        end = text.find('\n', max(start, len(text) * index // count)) + 1
+        if end == 0:
+            break
+        if end > start:
+            chunks.append(text[start:end])
+            start = end
+    if start < len(text):
+        chunks.append(text[start:])
+    return chunks
+
+
+def scan_chunk(text, first=False, checkpoint_lines=PARALLEL_SCAN_CHECKPOINT_LINES):
+    # Scans a chunk of a document as if it started outside any block.
+    # Returns the header records numbered from the start of the chunk, the
+    # lexer state and the numbers of records and of headers skipped in
+    # blocks after every checkpoint_lines lines, and the number of lines.
+    mt = get_engine()
+    lines = split_lines(text)
+    state = mt.lexer.START if first else mt.lexer.TEXT_STATE
+    records = []
+    checkpoints = []
+    engine_stats, mt.stats = mt.stats, Stats()
+    try:
+        for start in range(0, len(lines), checkpoint_lines):
+            end = min(start + checkpoint_lines, len(lines))
+            found, state = mt.scan_header_records(lines[start:end], state, start + 1,
+                                                  lines[start - 1] if start else None)
+            records += found
+            checkpoints.append((end, state, len(records), mt.stats.counters['headers_skipped_in_blocks']))
+    finally:
+        mt.stats = engine_stats
+    return records, checkpoints, len(lines)
+
+
+def parse_headers_parallel(mt, text, lines, jobs=0, min_chunk_size=None, checkpoint_lines=PARALLEL_SCAN_CHECKPOINT_LINES):
+    # Scans chunks of text in parallel processes and merges the headers in
+    # order. A chunk that does not start outside any block, like one starting
+    # inside a highlight block, is scanned again from the state at the end of
+    # the chunk before it, until the states agree at a checkpoint. The result
+    # and the stats counters are the same as those of parse_header_store(lines).
+    count = min(jobs or os.cpu_count() or 1, len(text) // (min_chunk_size or PARALLEL_SCAN_MIN_CHUNK_SIZE))
+    chunks = split_text_chunks(text, count)
+    if len(chunks) < 2:
+        return mt.parse_header_store(lines)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        scans = list(executor.map(scan_chunk, chunks, [True] + [False] * (len(chunks) - 1),
+                                  [checkpoint_lines] * len(chunks)))
+
+    lexer = mt.lexer
+    records = []
+    state = lexer.START
+    offset = 0
+    for index, (chunk_records, checkpoints, line_count) in enumerate(scans):
+        resumed = state == (lexer.START if index == 0 else lexer.TEXT_STATE)
+        position = 0
+        found = 0
+        skipped = 0
+        for end, chunk_state, chunk_found, chunk_skipped in checkpoints:
+            if resumed:
+                break
+            start = offset + position
+            rescanned, state = mt.scan_header_records(lines[start:offset + end], state, start + 1,
+                                                      lines[start - 1] if start else None)
+            records += rescanned
+            position = end
+            found = chunk_found
+            skipped = chunk_skipped
+            resumed = state == chunk_state
+        if resumed:
+            records += [record._replace(line=record.line + offset) for record in chunk_records[found:]]
+            state = checkpoints[-1][1]
+            # Rescanned lines were counted by scan_header_records
+            if mt.stats is not None:
+                mt.stats.count('lines_scanned', line_count - position)
+                mt.stats.count('headers_found', len(chunk_records) - found)
+                mt.stats.count('headers_skipped_in_blocks', checkpoints[-1][3] - skipped)
+        offset += line_count
+
+    return HeaderStore(records)
+
+
+def add_toc_file(mt, filename, skip_headers=0, scan_jobs=1, atomic=False):
+    with open(filename, 'r') as f_in:
+        mtime_ns = os.fstat(f_in.fileno()).st_mtime_ns
+        text = f_in.read()
+        newline = detect_newline(f_in.newlines)
+        # Mixed newlines are all replaced by the first one, which changes
+        # bytes before the first changed character
+        in_place = not atomic and not isinstance(f_in.newlines, tuple)
+
+    lines = split_lines(text)
+    headers = None
+    if scan_jobs != 1:
+        headers = mt.run_stage('parse_headers', parse_headers_parallel, mt, text, lines, scan_jobs)
+    output_text = join_lines(mt.rewrite_lines(lines, skip_headers, headers))
+    return write_file(filename, output_text, text, newline, in_place, mtime_ns)
+
+
+def check_file(mt, filename, skip_headers=0, diff=False):
+    with open(filename, 'r') as f_in:
+        text = f_in.read()
+
+    lines = split_lines(text)
+    stale = mt.check_lines(lines, skip_headers)
+    if stale is None:
+        return None, None
+
+    details = None
+    if diff:
+        output_text = join_lines(mt.rewrite_lines(list(lines), skip_headers))
+        details = ''.join(difflib.unified_diff(text.splitlines(True),
+                                               output_text.splitlines(True),
+                                               filename,
+                                               filename))
+    return 'line {}: {}'.format(*stale), details
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_cache_entry(filename, digest=None):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns, digest or file_digest(filename)]
+
+
+def update_file(mt, filename, cached_digest=None, skip_headers=0, stream=False, use_cache=False, check=False, diff=False,
+                scan_jobs=1, atomic=False):
+    try:
+        if cached_digest is not None:
+            digest = file_digest(filename)
+            if digest == cached_digest:
+                return FileResult(filename, 'unchanged', None, file_cache_entry(filename, digest), None, None)
+        if check:
+            reason, details = check_file(mt, filename, skip_headers, diff)
+            if reason is not None:
+                return FileResult(filename, 'stale', reason, None, details, None)
+            changed = False
+        elif stream:
+            changed = add_toc_stream_file(mt, filename, skip_headers)
+        else:
+            changed = add_toc_file(mt, filename, skip_headers, scan_jobs, atomic)
+        cache_entry = file_cache_entry(filename) if use_cache else None
+    except Exception as e:
+        return FileResult(filename, 'failed', str(e) or type(e).__name__, None, None, None)
+    return FileResult(filename, 'changed' if changed else 'unchanged', None, cache_entry, None, None)
+
+
+def process_file(filename, cached_digest=None, skip_headers=0, slug_dialect='mdtoc', stats=False, **options):
+    mt = get_engine(slug_dialect)
+    if not stats:
+        return update_file(mt, filename, cached_digest, skip_headers, **options)
+
+    file_stats = mt.stats = Stats()
+    start = time.perf_counter()
+    try:
+        bytes_read = os.path.getsize(filename)
+    except OSError:
+        bytes_read = 0
+    try:
+        result = update_file(mt, filename, cached_digest, skip_headers, **options)
+    finally:
+        mt.stats = None
+
+    file_stats.add_time('total', time.perf_counter() - start)
+    file_stats.count('files')
+    if cached_digest is not None and result.cache_entry and result.cache_entry[2] == cached_digest:
+        file_stats.count('files_cached')
+    file_stats.count('bytes_read', bytes_read)
+    if result.status == 'changed':
+        file_stats.count('bytes_written', os.path.getsize(filename))
+    file_stats.update_peak_memory()
+    return result._replace(stats=file_stats.as_dict())
+
+
+class ContentCache:
+
+    FILENAME = 'cache.json'
+
+    def __init__(self, directory, fingerprint):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.entries = {}
+
+    @staticmethod
+    def make_fingerprint(**options):
+        # Any change to the mdtoc source or to options affecting the output
+        # invalidates every entry.
+        options['source'] = file_digest(os.path.abspath(__file__))
+        return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def key(self, filename):
+        return os.path.abspath(filename)
+
+    def load(self):
+        try:
+            with open(os.path.join(self.directory, self.FILENAME), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        if isinstance(data, dict) and data.get('fingerprint') == self.fingerprint:
+            self.entries = data.get('files', {})
+        return self
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, delete=False) as f:
+            json.dump({'fingerprint': self.fingerprint, 'files': self.entries}, f)
+        os.replace(f.name, os.path.join(self.directory, self.FILENAME))
+
+    def lookup(self, filename):
+        return self.entries.get(self.key(filename))
+
+    def is_fresh(self, filename):
+        entry = self.lookup(filename)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        return entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+
+    def update(self, result):
+        if result.cache_entry is None:
+            self.entries.pop(self.key(result.filename), None)
+        else:
+            self.entries[self.key(result.filename)] = result.cache_entry
+
+
+def filter_stdin(mt, skip_headers=0):
+    # stdin can only be read once, so spool it for the second pass.
+    # SpooledTemporaryFile keeps small inputs in memory.
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024, mode='w+') as spool:
+        for line in sys.stdin:
+            spool.write(line)
+        add_toc_stream(mt, spool, sys.stdout, skip_headers)
+
+
+def matches_any(path, patterns):
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def collect_files(paths, recursive=False, include=None, exclude=None):
+    include = include or ['*.md']
+    exclude = exclude or []
+    filenames = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                candidates = []
+                for directory, subdirectories, files in os.walk(path):
+                    subdirectories[:] = sorted(d for d in subdirectories
+                                               if not matches_any(os.path.join(directory, d), exclude))
+                    candidates += [os.path.join(directory, f) for f in sorted(files)]
+            else:
+                candidates = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+            candidates = [c for c in candidates if os.path.isfile(c) and matches_any(c, include)]
+        elif any(c in path for c in '*?['):
+            candidates = [c for c in sorted(glob.glob(path, recursive=True)) if os.path.isfile(c)]
+        else:
+            candidates = [path]
+
+        filenames += [c for c in candidates if not matches_any(c, exclude)]
+
+    return list(dict.fromkeys(filenames))
+
+
+def run_git(arguments):
+    try:
+        process = subprocess.run(['git', '--glob-pathspecs'] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise MdTocError('git: ' + str(e))
+    if process.returncode != 0:
+        raise MdTocError('git ' + arguments[0] + ': ' + os.fsdecode(process.stderr).strip())
+    return os.fsdecode(process.stdout)
+
+
+def git_changed_files(paths, changed_since=None, staged=False):
+    # Files under paths that differ from changed_since or are staged, relative
+    # to the current directory. Deleted files are left out
+    toplevel = run_git(['rev-parse', '--show-toplevel']).rstrip('\n')
+    arguments = ['diff', '--name-only', '-z', '--diff-filter=d']
+    if staged:
+        arguments.append('--cached')
+    if changed_since:
+        arguments.append(changed_since)
+    names = run_git(arguments + ['--'] + list(paths)).split('\0')
+    return [os.path.relpath(os.path.join(toplevel, name)) for name in names if name]
+
+
+def select_changed_files(changed, paths, recursive=False, include=None, exclude=None):
+    # Picks the files collect_files would find in paths, without walking directories
+    include = include or ['*.md']
+    exclude = exclude or []
+    directories = [os.path.abspath(path) for path in paths if os.path.isdir(path)]
+    filenames = []
+
+    for filename in changed:
+        if not os.path.isfile(filename) or matches_any(filename, exclude):
+            continue
+        parent = os.path.dirname(os.path.abspath(filename))
+        containing = [d for d in directories if (parent + os.sep).startswith(d + os.sep)]
+        if containing:
+            if not matches_any(filename, include) or not (recursive or parent in containing):
+                continue
+            subdirectory = os.path.dirname(filename)
+            top = max(containing, key=len)
+            excluded = False
+            while os.path.abspath(subdirectory) != top and not excluded:
+                excluded = matches_any(subdirectory, exclude)
+                subdirectory = os.path.dirname(subdirectory)
+            if excluded:
+                continue
+        filenames.append(filename)
+
+    return list(dict.fromkeys(filenames))
+
+
+def git_fully_staged_files(filenames):
+    # Files with staged changes and no unstaged ones, which can be added to
+    # the index again without adding changes the user left out
+    if not filenames:
+        return []
+    unstaged = set(git_changed_files(filenames))
+    return [filename for filename in git_changed_files(filenames, staged=True) if filename not in unstaged]
+
+
+def stage_files(filenames):
+    if filenames:
+        run_git(['add', '--'] + list(filenames))
+
+
+def cached_file_stats():
+    file_stats = Stats()
+    file_stats.count('files')
+    file_stats.count('files_cached')
+    return file_stats.as_dict()
+
+
+def run_batch(filenames, jobs=1, cache=None, **options):
+    cached_digests = [None] * len(filenames)
+    if cache is not None:
+        options['use_cache'] = True
+        stale_filenames = []
+        cached_digests = []
+        for filename in filenames:
+            entry = cache.lookup(filename)
+            if cache.is_fresh(filename):
+                yield FileResult(filename, 'unchanged', None, entry, None, cached_file_stats() if options.get('stats') else None)
+            else:
+                stale_filenames.append(filename)
+                cached_digests.append(entry[2] if entry else None)
+        filenames = stale_filenames
+
+    process = functools.partial(process_file, **options)
+    if jobs == 1 or len(filenames) < 2:
+        results = map(process, filenames, cached_digests)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None)
+        chunksize = max(1, len(filenames) // (8 * (jobs or os.cpu_count() or 1)))
+        results = executor.map(process, filenames, cached_digests, chunksize=chunksize)
+
+    try:
+        for result in results:
+            if cache is not None:
+                cache.update(result)
+            yield result
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def report_results(results, summary=True, check=False, stats=None):
+    counts = collections.Counter()
+
+    for result in results:
+        counts[result.status] += 1
+        if stats is not None and result.stats is not None:
+            stats.merge(result.stats)
+        if result.status == 'failed':
+            print('ERROR: ' + result.filename + ': ' + result.error, file=sys.stderr)
+        elif result.status == 'stale':
+            print(result.filename + ': ' + result.error)
+        if result.details:
+            sys.stdout.write(result.details)
+
+    if summary and check:
+        print('{} stale, {} up to date, {} failed'.format(counts['stale'], counts['unchanged'], counts['failed']))
+    elif summary:
+        print('{} changed, {} unchanged, {} failed'.format(counts['changed'], counts['unchanged'], counts['failed']))
+
+    return counts
+
+
+def header_index_records(filename, slug_dialect='mdtoc'):
+    mt = get_engine(slug_dialect)
+    try:
+        if filename == '-':
+            headers = mt.parse_headers(line.rstrip('\n') for line in sys.stdin)
+        else:
+            with open(filename, 'r') as f_in:
+                headers = mt.parse_headers(read_file_lines(f_in))
+        mt.generate_tags(headers)
+    except Exception as e:
+        return filename, None, str(e) or type(e).__name__
+    records = [{'file': filename,
+                'line': header['line'],
+                'level': header['level'],
+                'title': header['header'].rstrip(),
+                'tag': header['tag'],
+                'new_tag': header['new_tag']} for header in headers]
+    return filename, records, None
+
+
+def emit_index(filenames, output_format='ndjson', slug_dialect='mdtoc', jobs=1, f_out=None):
+    # Writes header records of each file as soon as the file is parsed,
+    # returns the number of files that could not be read
+    f_out = f_out or sys.stdout
+    index = functools.partial(header_index_records, slug_dialect=slug_dialect)
+    if jobs == 1 or len(filenames) < 2:
+        results = map(index, filenames)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None)
+        chunksize = max(1, len(filenames) // (8 * (jobs or os.cpu_count() or 1)))
+        results = executor.map(index, filenames, chunksize=chunksize)
+
+    failed = 0
+    first = True
+    if output_format == 'json':
+        f_out.write('[')
+    try:
+        for filename, records, error in results:
+            if error is not None:
+                print('ERROR: ' + filename + ': ' + error, file=sys.stderr)
+                failed += 1
+                continue
+            for record in records:
+                if output_format == 'json':
+                    f_out.write(('\n' if first else ',\n') + json.dumps(record))
+                else:
+                    f_out.write(json.dumps(record) + '\n')
+                first = False
+            f_out.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if output_format == 'json':
+        f_out.write(']\n' if first else '\n]\n')
+    return failed
+
 
 def parse_command_line_arguments():
 
@@ -258,34 +1744,785 @@ article.md after:
     Some text below header 2
 """
     parser = argparse.ArgumentParser(description=parser_help_text,formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("filename", help="Markdown file to add table of contents to")
+    parser.add_argument("paths",
+                        help="Markdown files, directories or glob patterns to add table of contents to, or - to filter stdin to stdout",
+                        nargs='+')
     parser.add_argument("--skip_headers",
                         help="number of headers in the beginning of the file to not include in the toc (default: 0)",
                         default=0)
+    parser.add_argument("--slug_dialect",
+                        help="rules used to turn header titles into anchor names (default: mdtoc)",
+                        choices=SLUG_DIALECTS,
+                        default='mdtoc')
+    parser.add_argument("--stream",
+                        help="process the file in two streaming passes instead of loading it into memory",
+                        action='store_true')
+    parser.add_argument("-r", "--recursive",
+                        help="process Markdown files in subdirectories of given directories",
+                        action='store_true')
+    parser.add_argument("--include",
+                        help="file name pattern to process in directories, can be repeated (default: *.md)",
+                        action='append')
+    parser.add_argument("--exclude",
+                        help="file or directory name pattern to skip, can be repeated",
+                        action='append')
+    parser.add_argument("-j", "--jobs",
+                        help="number of files to process in parallel, 0 uses all CPUs (default: 1)",
+                        type=int,
+                        default=1)
+    parser.add_argument("--atomic",
+                        help="write a complete new file and rename it over the old one, so an interrupted run never leaves a partly written file (default: rewrite the changed end of the file in place)",
+                        action='store_true')
+    parser.add_argument("--cache",
+                        help="skip files whose content matches the output of the previous run",
+                        action='store_true')
+    parser.add_argument("--cache_dir",
+                        help="directory where --cache records file contents (default: .mdtoc-cache)",
+                        default='.mdtoc-cache')
+    parser.add_argument("--check",
+                        help="only report files whose anchors or table of contents are out of date, without writing",
+                        action='store_true')
+    parser.add_argument("--diff",
+                        help="with --check, print a unified diff of the changes mdtoc would make",
+                        action='store_true')
+    parser.add_argument("--scan_jobs",
+                        help="number of processes scanning chunks of each large file for headers, 0 uses all CPUs (default: 1)",
+                        type=int,
+                        default=1)
+    parser.add_argument("--stats",
+                        help="print timings and counters to stderr",
+                        action='store_true')
+    parser.add_argument("--stats_format",
+                        help="format of --stats output (default: text)",
+                        choices=['text', 'json'],
+                        default='text')
+    parser.add_argument("--emit_index",
+                        help="write the headers of each file to stdout as JSON or NDJSON instead of updating files",
+                        choices=['json', 'ndjson'])
+    parser.add_argument("--changed_since",
+                        help="only process files that git reports as changed since the given commit, and stage rewritten files that were fully staged",
+                        metavar='REF')
+    parser.add_argument("--staged",
+                        help="only process files with changes staged in git, and stage them again after rewriting. Files with unstaged changes are refused",
+                        action='store_true')
+    parser.add_argument("--watch",
+                        help="keep running and update files when they are saved",
+                        action='store_true')
+    parser.add_argument("--interval",
+                        help="seconds between checks for changed files in --watch mode (default: 0.5)",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--debounce",
+                        help="seconds a file must stay unchanged before --watch updates it (default: 0.2)",
+                        type=float,
+                        default=0.2)
     args = parser.parse_args()
 
-    filename = args.filename
-    skip_headers = int(args.skip_headers)
+    if '-' in args.paths and len(args.paths) > 1:
+        parser.error('- cannot be combined with other paths')
+    if args.scan_jobs != 1 and args.jobs != 1:
+        parser.error('--scan_jobs cannot be combined with --jobs')
+    if args.diff and not args.check:
+        parser.error('--diff requires --check')
+    if args.scan_jobs != 1 and (args.check or args.stream):
+        parser.error('--scan_jobs cannot be combined with --check or --stream')
+    if args.paths == ['-'] and (args.changed_since or args.staged):
+        parser.error('--changed_since and --staged cannot be used with -')
+
+    args.skip_headers = int(args.skip_headers)
+
+    return args
+
+class Watcher:
+
+    def __init__(self, paths, mt, skip_headers=0, recursive=False, include=None, exclude=None, debounce=0.2):
+        self.paths = paths
+        self.mt = mt
+        self.skip_headers = skip_headers
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.debounce = debounce
+        self.signatures = {}
+        self.pending = {}
+        # Parsed documents, matching the files as last read or written
+        self.documents = {}
+
+    def signature(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def start(self):
+        for filename in collect_files(self.paths, self.recursive, self.include, self.exclude):
+            self.signatures[filename] = self.signature(filename)
+
+    def update(self, filename):
+        with open(filename, 'r') as f_in:
+            text = f_in.read()
+            newline = detect_newline(f_in.newlines)
+
+        # Only the lines changed since the last update are parsed again
+        lines = split_lines(text)
+        document = self.documents.get(filename)
+        if document is None:
+            document = self.documents[filename] = Document(lines, self.mt)
+        else:
+            document.replace(lines)
+        output_lines = document.rewrite(self.skip_headers)
+        changed = write_file(filename, join_lines(output_lines), text, newline)
+        document.replace(output_lines)
+        return changed
+
+    def poll(self, now=None):
+        now = time.monotonic() if now is None else now
+        results = []
+
+        for filename in collect_files(self.paths, self.recursive, self.include, self.exclude):
+            signature = self.signature(filename)
+            if signature is None or signature == self.signatures.get(filename):
+                self.pending.pop(filename, None)
+                continue
+            pending = self.pending.get(filename)
+            if pending is None or pending[0] != signature:
+                self.pending[filename] = (signature, now)
+                if self.debounce > 0:
+                    continue
+            elif now - pending[1] < self.debounce:
+                continue
+
+            del self.pending[filename]
+            try:
+                changed = self.update(filename)
+            except Exception as e:
+                result = FileResult(filename, 'failed', str(e) or type(e).__name__, None, None, None)
+            else:
+                result = FileResult(filename, 'changed' if changed else 'unchanged', None, None, None, None)
+            # Remember the signature after our own write so it is not
+            # picked up as a new change on the next poll.
+            self.signatures[filename] = self.signature(filename)
+            results.append(result)
+
+        return results
+
+    def run(self, interval=0.5):
+        self.start()
+        while True:
+            for result in self.poll():
+                if result.status == 'failed':
+                    print('ERROR: ' + result.filename + ': ' + result.error, file=sys.stderr)
+                elif result.status == 'changed':
+                    print('updated ' + result.filename)
+                sys.stdout.flush()
+            time.sleep(interval)
+
+
+def index_file(filename, slug_dialect='mdtoc'):
+    mt = get_engine(slug_dialect)
+    try:
+        stat = os.stat(filename)
+        with open(filename, 'r') as f_in:
+            text = f_in.read()
+        lines = split_lines(text)
+        headers = mt.generate_tags(mt.parse_headers(lines))
+        links = mt.parse_links(lines)
+    except Exception as e:
+        return filename, None, str(e) or type(e).__name__
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    rows = [(header['line'], header['level'], header['header'].rstrip(), header['tag'] or header['new_tag'])
+            for header in headers]
+    return filename, (stat.st_size, stat.st_mtime_ns, digest, rows, links), None
+
+
+class SiteIndex:
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT);
+        CREATE TABLE IF NOT EXISTS headers (path TEXT, position INTEGER, line INTEGER, level INTEGER,
+                                            title TEXT, anchor TEXT, PRIMARY KEY (path, position));
+        CREATE TABLE IF NOT EXISTS links (path TEXT, line INTEGER, target TEXT);
+        CREATE INDEX IF NOT EXISTS links_path ON links (path);
+    """
+
+    # Links with a scheme, protocol relative or site absolute links are not checked
+    regexp_external_link = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*:|/")
+
+    def __init__(self, db_path, slug_dialect='mdtoc'):
+        self.db_path = db_path
+        self.root = os.path.dirname(os.path.abspath(db_path))
+        self.slug_dialect = slug_dialect
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(self.SCHEMA)
+        fingerprint = ContentCache.make_fingerprint(slug_dialect=slug_dialect)
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            with self.connection:
+                self.connection.execute("DELETE FROM files")
+                self.connection.execute("DELETE FROM headers")
+                self.connection.execute("DELETE FROM links")
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+
+    def close(self):
+        self.connection.close()
+
+    def key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root).replace(os.sep, '/')
+
+    def update(self, filenames, jobs=1, prune=True):
+        # Returns counts of updated, unchanged, removed and failed files.
+        # With prune, files not in filenames are removed from the index,
+        # otherwise they are updated too and only removed once deleted.
+        counts = collections.Counter()
+        known = {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest
+                 in self.connection.execute("SELECT path, size, mtime_ns, digest FROM files")}
+        if not prune:
+            filenames = list(filenames)
+            given = set(self.key(filename) for filename in filenames)
+            filenames += [os.path.join(self.root, key) for key in sorted(known) if key not in given
+                          and os.path.isfile(os.path.join(self.root, key))]
+        keys = {}
+        stale = []
+        for filename in filenames:
+            key = self.key(filename)
+            keys[key] = filename
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                stat = None
+            entry = known.get(key)
+            if stat is not None and entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                counts['unchanged'] += 1
+            else:
+                stale.append(filename)
+
+        index = functools.partial(index_file, slug_dialect=self.slug_dialect)
+        executor = None
+        if jobs == 1 or len(stale) < 2:
+            results = map(index, stale)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None)
+            results = executor.map(index, stale, chunksize=max(1, len(stale) // (8 * (jobs or os.cpu_count() or 1))))
+
+        try:
+            self.store(results, known, keys, counts)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return counts
+
+    def store(self, results, known, keys, counts):
+        with self.connection:
+            for filename, indexed, error in results:
+                key = self.key(filename)
+                if error is not None:
+                    print('ERROR: ' + filename + ': ' + error, file=sys.stderr)
+                    counts['failed'] += 1
+                    continue
+                size, mtime_ns, digest, rows, links = indexed
+                entry = known.get(key)
+                self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (key, size, mtime_ns, digest))
+                if entry is not None and entry[2] == digest:
+                    counts['unchanged'] += 1
+                    continue
+                self.connection.execute("DELETE FROM headers WHERE path = ?", (key,))
+                self.connection.executemany("INSERT INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                                            [(key, position) + row for position, row in enumerate(rows)])
+                self.connection.execute("DELETE FROM links WHERE path = ?", (key,))
+                self.connection.executemany("INSERT INTO links VALUES (?, ?, ?)",
+                                            [(key, line, target) for line, target in links])
+                counts['updated'] += 1
+
+            for key in set(known) - set(keys):
+                self.connection.execute("DELETE FROM files WHERE path = ?", (key,))
+                self.connection.execute("DELETE FROM headers WHERE path = ?", (key,))
+                self.connection.execute("DELETE FROM links WHERE path = ?", (key,))
+                counts['removed'] += 1
+
+    def duplicate_anchors(self):
+        return self.connection.execute("SELECT path, anchor, COUNT(*) FROM headers GROUP BY path, anchor "
+                                       "HAVING COUNT(*) > 1 ORDER BY path, anchor").fetchall()
+
+    def broken_links(self, keys=None):
+        # Returns (path, line, target, reason) for links to missing files or
+        # to anchors the target file does not have, in the files with the
+        # given keys or in all files
+        anchors = set(self.connection.execute("SELECT path, anchor FROM headers"))
+        paths = set(path for path, in self.connection.execute("SELECT path FROM files"))
+        broken = []
+
+        for path, line, target in self.connection.execute("SELECT path, line, target FROM links ORDER BY path, line"):
+            if self.regexp_external_link.match(target) or keys is not None and path not in keys:
+                continue
+            target_path, _, anchor = target.partition('#')
+            target_path = urllib.parse.unquote(target_path.partition('?')[0])
+            key = posixpath.normpath(posixpath.join(posixpath.dirname(path), target_path)) if target_path else path
+            if key not in paths:
+                if not os.path.exists(os.path.join(self.root, key)):
+                    broken.append((path, line, target, 'file not found'))
+                continue
+            if anchor and (key, urllib.parse.unquote(anchor)) not in anchors:
+                broken.append((path, line, target, 'anchor not found'))
+
+        return broken
+
+    def generate_toc(self, output_filename, toc_header='Contents'):
+        output_directory = os.path.dirname(os.path.abspath(output_filename))
+        toc = []
+        path = None
+        level_mins = dict(self.connection.execute("SELECT path, MIN(level) FROM headers WHERE title != ? GROUP BY path",
+                                                  (toc_header,)))
+        rows = self.connection.execute("SELECT path, level, title, anchor FROM headers "
+                                       "WHERE title != ? ORDER BY path, position", (toc_header,))
+
+        for row_path, level, title, anchor in rows:
+            if row_path != path:
+                path = row_path
+                link = os.path.relpath(os.path.join(self.root, path), output_directory).replace(os.sep, '/')
+                level_min = level_mins[path]
+                toc.append('* [' + path + '](' + link + ')')
+            spaces = ' ' * (4 * (1 + level - level_min))
+            toc.append(spaces + '* [' + title + '](' + link + '#' + anchor + ')')
+
+        return toc
+
+
+def parse_index_arguments(argv):
+    parser = argparse.ArgumentParser(prog='mdtoc.py index',
+                                     description='Record headers of many files and write a cross-document table of contents')
+    parser.add_argument("paths", help="Markdown files, directories or glob patterns to index", nargs='+')
+    parser.add_argument("--db", help="SQLite file holding the index (default: .mdtoc-index.sqlite)",
+                        default='.mdtoc-index.sqlite')
+    parser.add_argument("--output", help="Markdown file to write the cross-document table of contents to")
+    parser.add_argument("-r", "--recursive", help="index Markdown files in subdirectories of given directories",
+                        action='store_true')
+    parser.add_argument("--include", help="file name pattern to index in directories, can be repeated (default: *.md)",
+                        action='append')
+    parser.add_argument("--exclude", help="file or directory name pattern to skip, can be repeated", action='append')
+    parser.add_argument("--slug_dialect",
+                        help="rules used to turn header titles into anchor names (default: mdtoc)",
+                        choices=SLUG_DIALECTS,
+                        default='mdtoc')
+    parser.add_argument("-j", "--jobs", help="number of files to parse in parallel, 0 uses all CPUs (default: 1)",
+                        type=int,
+                        default=1)
+    return parser.parse_args(argv)
+
+
+def index_main(argv):
+    args = parse_index_arguments(argv)
+    exclude = (args.exclude or []) + ([os.path.basename(args.output)] if args.output else [])
+    filenames = collect_files(args.paths, args.recursive, args.include, exclude)
+
+    site_index = SiteIndex(args.db, args.slug_dialect)
+    try:
+        counts = site_index.update(filenames, args.jobs)
+        for path, anchor, count in site_index.duplicate_anchors():
+            print('WARNING: {}: anchor {} used {} times'.format(path, anchor, count), file=sys.stderr)
+        if args.output:
+            original_text = None
+            if os.path.exists(args.output):
+                with open(args.output, 'r') as f_in:
+                    original_text = f_in.read()
+            write_file(args.output, join_lines(site_index.generate_toc(args.output)), original_text)
+    finally:
+        site_index.close()
+
+    print('{} updated, {} unchanged, {} removed, {} failed'.format(counts['updated'],
+                                                                    counts['unchanged'],
+                                                                    counts['removed'],
+                                                                    counts['failed']))
+    if counts['failed']:
+        sys.exit(1)
+
+
+def parse_links_arguments(argv):
+    parser = argparse.ArgumentParser(prog='mdtoc.py links',
+                                     description='Report links to missing files and anchors in Markdown files')
+    parser.add_argument("paths", help="Markdown files, directories or glob patterns to check", nargs='+')
+    parser.add_argument("--db", help="SQLite file holding the index (default: .mdtoc-index.sqlite)",
+                        default='.mdtoc-index.sqlite')
+    parser.add_argument("-r", "--recursive", help="check Markdown files in subdirectories of given directories",
+                        action='store_true')
+    parser.add_argument("--include", help="file name pattern to check in directories, can be repeated (default: *.md)",
+                        action='append')
+    parser.add_argument("--exclude", help="file or directory name pattern to skip, can be repeated", action='append')
+    parser.add_argument("--slug_dialect",
+                        help="rules used to turn header titles into anchor names (default: mdtoc)",
+                        choices=SLUG_DIALECTS,
+                        default='mdtoc')
+    parser.add_argument("-j", "--jobs", help="number of files to parse in parallel, 0 uses all CPUs (default: 1)",
+                        type=int,
+                        default=1)
+    return parser.parse_args(argv)
+
+
+def links_main(argv):
+    args = parse_links_arguments(argv)
+    filenames = collect_files(args.paths, args.recursive, args.include, args.exclude)
+
+    site_index = SiteIndex(args.db, args.slug_dialect)
+    try:
+        # Files indexed before but not checked now stay in the index
+        counts = site_index.update(filenames, args.jobs, prune=False)
+        broken = site_index.broken_links(set(site_index.key(filename) for filename in filenames))
+    finally:
+        site_index.close()
+
+    for path, line, target, reason in broken:
+        print('{}:{}: {}: {}'.format(path, line, reason, target))
+    print('{} broken links in {} files'.format(len(broken), len(filenames)))
+    if broken or counts['failed']:
+        sys.exit(1)
+
+
+SERVER_LINE_LIMIT = 1024 * 1024 * 1024
+
+
+def handle_request(request):
+    mt = get_engine(request.get('slug_dialect', 'mdtoc'))
+    skip_headers = int(request.get('skip_headers', 0))
+    action = request.get('action', 'rewrite')
+    path = request.get('path')
+
+    if 'text' in request:
+        text = request['text']
+        newline = '\n'
+    elif path is not None:
+        with open(path, 'r') as f_in:
+            text = f_in.read()
+            newline = detect_newline(f_in.newlines)
+    else:
+        raise MdTocError('Request must contain text or path')
+
+    lines = split_lines(text)
+    if action == 'headers':
+        return {'headers': mt.generate_tags(mt.parse_headers(lines))}
+    if action == 'check':
+        stale = mt.check_lines(lines, skip_headers)
+        return {'stale': None if stale is None else {'line': stale[0], 'reason': stale[1]}}
+    if action != 'rewrite':
+        raise MdTocError('Unknown action: ' + str(action))
+
+    output_text = join_lines(mt.rewrite_lines(lines, skip_headers))
+    if request.get('write'):
+        if path is None:
+            raise MdTocError('write requires path')
+        return {'changed': write_file(path, output_text, text, newline)}
+    return {'text': output_text}
+
+
+def respond(request_line):
+    try:
+        request = json.loads(request_line)
+    except ValueError as e:
+        return {'ok': False, 'error': 'Invalid request: ' + str(e)}
+
+    response = {'ok': True}
+    if isinstance(request, dict) and 'id' in request:
+        response['id'] = request['id']
+    try:
+        if not isinstance(request, dict):
+            raise MdTocError('Request must be a JSON object')
+        response.update(handle_request(request))
+    except Exception as e:
+        response['ok'] = False
+        response['error'] = str(e) or type(e).__name__
+    return response
+
+
+async def serve_stream(reader, write):
+    # Requests are handled in worker threads as they arrive, responses are
+    # written in completion order and matched to requests by their id.
+    loop = asyncio.get_event_loop()
+    pending = set()
+
+    async def handle(request_line):
+        response = await loop.run_in_executor(None, respond, request_line)
+        await write((json.dumps(response) + '\n').encode('utf-8'))
+
+    while True:
+        request_line = await reader.readline()
+        if not request_line:
+            break
+        if request_line.strip():
+            pending.add(loop.create_task(handle(request_line)))
+            pending = set(task for task in pending if not task.done())
+
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def serve_connection(reader, writer):
+    async def write(data):
+        writer.write(data)
+        await writer.drain()
+
+    try:
+        await serve_stream(reader, write)
+    finally:
+        writer.close()
+
+
+def start_unix_server(path):
+    # A socket left by a previous server is replaced, anything else is kept
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            raise MdTocError(path + ' exists and is not a socket')
+        os.unlink(path)
+    return asyncio.start_unix_server(serve_connection, path, limit=SERVER_LINE_LIMIT)
+
+
+class ThreadLineReader:
+    # Reads lines in a worker thread, for input connect_read_pipe does not
+    # support, like a regular file redirected to stdin
+
+    def __init__(self, f):
+        self.f = f
+
+    async def readline(self):
+        return await asyncio.get_event_loop().run_in_executor(None, self.f.readline)
+
+
+def is_pipe_or_terminal(f):
+    mode = os.fstat(f.fileno()).st_mode
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or f.isatty()
+
+
+async def serve_stdio():
+    loop = asyncio.get_event_loop()
+    if is_pipe_or_terminal(sys.stdin):
+        reader = asyncio.StreamReader(limit=SERVER_LINE_LIMIT)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    else:
+        reader = ThreadLineReader(sys.stdin.buffer)
+
+    async def write(data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    await serve_stream(reader, write)
+
+
+def client_requests(path, requests):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        for index, request in enumerate(requests):
+            request = dict(request, id=index)
+            connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        connection.shutdown(socket.SHUT_WR)
+
+        responses = [None] * len(requests)
+        with connection.makefile('r', encoding='utf-8') as f:
+            for response_line in f:
+                response = json.loads(response_line)
+                responses[response['id']] = response
+    return responses
+
+
+def parse_serve_arguments(argv):
+    parser = argparse.ArgumentParser(prog='mdtoc.py serve',
+                                     description='Serve newline-delimited JSON requests from a resident mdtoc process')
+    channel = parser.add_mutually_exclusive_group(required=True)
+    channel.add_argument("--socket", help="Unix domain socket to listen on")
+    channel.add_argument("--stdio", help="read requests from stdin and write responses to stdout", action='store_true')
+    parser.add_argument("--slug_dialect",
+                        help="slug dialect to prepare before the first request (default: mdtoc)",
+                        choices=SLUG_DIALECTS,
+                        default='mdtoc')
+    return parser.parse_args(argv)
+
+
+def serve_main(argv):
+    args = parse_serve_arguments(argv)
+    get_engine(args.slug_dialect)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        if args.stdio:
+            loop.run_until_complete(serve_stdio())
+        else:
+            server = loop.run_until_complete(start_unix_server(args.socket))
+            try:
+                loop.run_forever()
+            finally:
+                server.close()
+                os.unlink(args.socket)
+    except KeyboardInterrupt:
+        pass
+    except MdTocError as e:
+        print('ERROR: ' + str(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        loop.close()
+
+
+def parse_client_arguments(argv):
+    parser = argparse.ArgumentParser(prog='mdtoc.py client',
+                                     description='Send files to a running mdtoc server')
+    parser.add_argument("--socket", help="Unix domain socket of the server", required=True)
+    parser.add_argument("paths", help="Markdown files to add table of contents to, or - for stdin", nargs='+')
+    parser.add_argument("--skip_headers",
+                        help="number of headers in the beginning of the file to not include in the toc (default: 0)",
+                        type=int,
+                        default=0)
+    parser.add_argument("--slug_dialect",
+                        help="rules used to turn header titles into anchor names (default: mdtoc)",
+                        choices=SLUG_DIALECTS,
+                        default='mdtoc')
+    parser.add_argument("--headers", help="print the header index as JSON instead of rewriting", action='store_true')
+    return parser.parse_args(argv)
+
+
+def client_main(argv):
+    args = parse_client_arguments(argv)
+    options = {'skip_headers': args.skip_headers,
+               'slug_dialect': args.slug_dialect,
+               'action': 'headers' if args.headers else 'rewrite'}
+    requests = []
+    for path in args.paths:
+        if path == '-':
+            requests.append(dict(options, text=sys.stdin.read()))
+        else:
+            requests.append(dict(options, path=os.path.abspath(path), write=not args.headers))
+
+    failed = False
+    for path, response in zip(args.paths, client_requests(args.socket, requests)):
+        if not response['ok']:
+            print('ERROR: ' + path + ': ' + response['error'], file=sys.stderr)
+            failed = True
+        elif args.headers:
+            print(json.dumps({'path': path, 'headers': response['headers']}))
+        elif 'text' in response:
+            sys.stdout.write(response['text'])
+
+    if failed:
+        sys.exit(1)
+
+
+def print_stats(stats, output_format='text'):
+    if output_format == 'json':
+        print(json.dumps(stats.as_dict(), sort_keys=True), file=sys.stderr)
+    else:
+        print(stats.format(), file=sys.stderr)
 
-    return filename, skip_headers
 
 def main():
-    mt = MdToc()
-    input_lines = []
-    
-    filename, skip_headers = parse_command_line_arguments()
-    
-    f_in = open(filename, 'r')
-    for line in f_in:
-        input_lines.append(line.rstrip('\n'))
-    f_in.close()
-    
-    output_lines = mt.add_toc(input_lines, skip_headers)
-    
-    f_out = open(filename, 'w')
-    for line in output_lines:
-        f_out.write(line + '\n')
-    f_out.close()
+    if sys.argv[1:2] == ['serve']:
+        return serve_main(sys.argv[2:])
+    if sys.argv[1:2] == ['client']:
+        return client_main(sys.argv[2:])
+    if sys.argv[1:2] == ['index']:
+        return index_main(sys.argv[2:])
+    if sys.argv[1:2] == ['links']:
+        return links_main(sys.argv[2:])
+
+    args = parse_command_line_arguments()
+    stats = Stats() if args.stats else None
+
+    if args.emit_index:
+        filenames = args.paths if args.paths == ['-'] else collect_files(args.paths, args.recursive, args.include, args.exclude)
+        if emit_index(filenames, args.emit_index, args.slug_dialect, args.jobs):
+            sys.exit(1)
+        return
+
+    if args.paths == ['-']:
+        mt = get_engine(args.slug_dialect)
+        mt.stats = stats
+        try:
+            if args.check:
+                stale = mt.check_lines(split_lines(sys.stdin.read()), args.skip_headers)
+                if stale is not None:
+                    print('-: line {}: {}'.format(*stale))
+                    sys.exit(1)
+            else:
+                filter_stdin(mt, args.skip_headers)
+        except MdTocError as e:
+            print('ERROR: ' + str(e), file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if stats is not None:
+                stats.count('files')
+                stats.update_peak_memory()
+                print_stats(stats, args.stats_format)
+        return
+
+    if args.watch:
+        watcher = Watcher(args.paths,
+                          get_engine(args.slug_dialect),
+                          args.skip_headers,
+                          args.recursive,
+                          args.include,
+                          args.exclude,
+                          args.debounce)
+        try:
+            watcher.run(args.interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    cache = None
+    if args.cache:
+        fingerprint = ContentCache.make_fingerprint(skip_headers=args.skip_headers, slug_dialect=args.slug_dialect)
+        cache = ContentCache(args.cache_dir, fingerprint).load()
+
+    use_git = bool(args.changed_since or args.staged)
+    stageable = set()
+    partially_staged = []
+    try:
+        if use_git:
+            changed = git_changed_files(args.paths, args.changed_since, args.staged)
+            filenames = select_changed_files(changed, args.paths, args.recursive, args.include, args.exclude)
+            stageable = set(git_fully_staged_files(filenames))
+            if args.staged and not args.check:
+                # Rewriting these and adding them would commit their unstaged changes
+                partially_staged = [f for f in filenames if f not in stageable]
+                filenames = [f for f in filenames if f in stageable]
+        else:
+            filenames = collect_files(args.paths, args.recursive, args.include, args.exclude)
+    except MdTocError as e:
+        print('ERROR: ' + str(e), file=sys.stderr)
+        sys.exit(1)
+
+    results = run_batch(filenames,
+                        args.jobs,
+                        cache,
+                        skip_headers=args.skip_headers,
+                        slug_dialect=args.slug_dialect,
+                        stream=args.stream,
+                        check=args.check,
+                        diff=args.diff,
+                        scan_jobs=args.scan_jobs,
+                        atomic=args.atomic,
+                        stats=stats is not None)
+    if use_git:
+        results = [FileResult(filename, 'failed', 'has unstaged changes, stage or stash them first', None, None, None)
+                   for filename in partially_staged] + list(results)
+    counts = report_results(results, summary=len(filenames) + len(partially_staged) > 1, check=args.check, stats=stats)
+
+    if use_git:
+        try:
+            stage_files([r.filename for r in results if r.status == 'changed' and r.filename in stageable])
+        except MdTocError as e:
+            print('ERROR: ' + str(e), file=sys.stderr)
+            counts['failed'] += 1
+
+    if cache is not None:
+        cache.save()
+
+    if stats is not None:
+        stats.update_peak_memory()
+        print_stats(stats, args.stats_format)
+
+    if counts['failed'] or counts['stale']:
+        sys.exit(1)
 
             
 if __name__ == '__main__':
@@ -0,0 +1,50 @@
+# Run:
+# $ python3 -m pytest -v
+
+import bench_mdtoc
+
+
+def test_generate_document_is_deterministic():
+    for profile in bench_mdtoc.PROFILES:
+        lines = bench_mdtoc.generate_document(500, profile)
+        assert 500 == len(lines)
+        assert lines == bench_mdtoc.generate_document(500, profile)
+        assert '## Contents' in lines
+
+
+def test_run_measures_all_stages():
+    results = bench_mdtoc.run([200], ['mixed', 'highlight'], repeat=1)
+
+    assert ['highlight-200', 'mixed-200'] == sorted(results['results'])
+    for result in results['results'].values():
+        assert sorted(bench_mdtoc.STAGES) == sorted(result['stages'])
+        assert result['peak_memory'] > 0
+        assert sorted(['dicts', 'store']) == sorted(result['header_memory'])
+
+
+def test_header_store_uses_less_memory_than_dicts():
+    lines = bench_mdtoc.generate_document(20000, 'header_dense')
+
+    memory = bench_mdtoc.measure_header_memory(lines)
+
+    assert memory['store'] * 2 < memory['dicts']
+
+
+def test_compare_reports_regressions():
+    baseline = {'results': {'mixed-1000': {'stages': {'parse_headers': 0.010, 'add_toc': 0.020},
+                                           'peak_memory': 1000}}}
+    current = {'results': {'mixed-1000': {'stages': {'parse_headers': 0.011, 'add_toc': 0.030},
+                                          'peak_memory': 2000}}}
+
+    regressions = bench_mdtoc.compare(baseline, current, threshold=0.25)
+
+    assert ['mixed-1000 add_toc: 0.0200s -> 0.0300s',
+            'mixed-1000 peak_memory: 1000 -> 2000 bytes'] == regressions
+    assert [] == bench_mdtoc.compare(baseline, current, threshold=2.0)
+
+
+def test_long_header_parsing_grows_linearly():
+    results = bench_mdtoc.measure_long_headers([20000, 200000])
+
+    for shape in bench_mdtoc.LONG_HEADER_SHAPES:
+        assert results[shape + '-200000'] < 30 * results[shape + '-20000']
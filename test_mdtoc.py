@@ -3,7 +3,16 @@
 
 import pytest
 import mdtoc
+import asyncio
+import io
+import json
+import mmap
+import os
+import random
+import subprocess
 import sys
+import threading
+import time
 
 
 def remove_indent(lines):
@@ -408,4 +417,1087 @@ def test_insert_toc_no_contents(mt, mocker):
     output = mt.insert_toc(lines_with_tags, toc)
 
     print.assert_called_with('ERROR: Document does not contain header with name Contents')
-    sys.exit.assert_called()
\ No newline at end of file
+    sys.exit.assert_called()
+
+def test_tokenize_header(mt):
+    line = '### Header 1<a name="header-1"></a>'
+    expect = mdtoc.HeaderRecord(level=3, title='Header 1', tag='header-1', line=7)
+    assert expect == mt.tokenize_header(line, 7)
+
+def test_tokenize_header_not_header(mt):
+    assert mt.tokenize_header("#not a header") is None
+
+def test_tokenize_header_tag_search_is_leftmost(mt):
+    line = '## a<a name="x"></a> b<a name="y"></a>'
+    record = mt.tokenize_header(line, 1)
+    assert record.title == 'a'
+    assert record.tag == 'x'
+
+def test_tokenize_headers_when_code_highlight_present(mt):
+    lines = []
+    lines.append("# header 1")
+    lines.append("{% highlight cpp %}")
+    lines.append("# comment")
+    lines.append("{% endhighlight %}")
+    lines.append("## header 2")
+
+    expect = []
+    expect.append(mdtoc.HeaderRecord(1, 'header 1', None, 1))
+    expect.append(mdtoc.HeaderRecord(2, 'header 2', None, 5))
+
+    assert expect == mt.tokenize_headers(lines)
+
+def test_generate_tags_duplicate_of_generated_suffix(mt):
+    i = []
+    i.append({'header': 'Header 2', 'level': 1, 'line': 1, 'tag': None})
+    i.append({'header': 'Header 2', 'level': 1, 'line': 2, 'tag': None})
+    i.append({'header': 'Header 2 2', 'level': 1, 'line': 3, 'tag': None})
+    i.append({'header': 'Header 2', 'level': 1, 'line': 4, 'tag': 'header-2-3'})
+    i.append({'header': 'Header 2', 'level': 1, 'line': 5, 'tag': None})
+
+    o = mt.generate_tags(i)
+
+    assert ['header-2', 'header-2-2', 'header-2-2-2', None, 'header-2-4'] == [h['new_tag'] for h in o]
+
+def test_anchor_registry_resolve():
+    registry = mdtoc.AnchorRegistry()
+    registry.add('a-2')
+    assert registry.resolve('a') == 'a'
+    assert registry.resolve('a') == 'a-3'
+    assert registry.resolve('a') == 'a-4'
+    assert 'a-3' in registry
+    assert len(registry) == 4
+
+def test_generate_tags_duplicates_scale_linearly(mt):
+    def time_generate_tags(count):
+        headers = [{'header': 'Parameters', 'level': 2, 'line': n, 'tag': None} for n in range(count)]
+        start = time.perf_counter()
+        mt.generate_tags(headers)
+        return time.perf_counter() - start, headers
+
+    small, _ = time_generate_tags(10000)
+    large, headers = time_generate_tags(100000)
+
+    assert headers[-1]['new_tag'] == 'parameters-100000'
+    assert large < small * 40
+
+def compose_name_attribute_legacy(header_text):
+    name_attribute = header_text.lower()
+    for old, new in [('(', ''), (')', ''), ('.', ''), ("'", ""), ('/', '-'), (' ', '-'),
+                     ('å', 'a'), ('ä', 'a'), ('ö', 'o'), ('&', 'and'), (':', '')]:
+        name_attribute = name_attribute.replace(old, new)
+    return name_attribute
+
+def test_mdtoc_slug_dialect_matches_legacy_rules(mt):
+    titles = ["Introduction (part 1.2)", "Tom's A/B test: Åsa & Örjan", "  trailing  ", "Café ÄÖÅ"]
+    for title in titles:
+        assert compose_name_attribute_legacy(title) == mt.compose_name_attribute(title)
+
+def test_slug_dialect_github():
+    mt = mdtoc.MdToc('github')
+    assert mt.compose_name_attribute("What's new in v1.2? (Beta)") == "whats-new-in-v12-beta"
+    assert mt.compose_name_attribute("Café & Co") == "café--co"
+
+def test_slug_dialect_gitlab():
+    mt = mdtoc.MdToc('gitlab')
+    assert mt.compose_name_attribute(" Café & Co ") == "café-co"
+    assert mt.compose_name_attribute("123") == "anchor-123"
+
+def test_slug_dialect_kramdown():
+    mt = mdtoc.MdToc('kramdown')
+    assert mt.compose_name_attribute("1. Café & Co") == "cafe--co"
+    assert mt.compose_name_attribute("123") == "section"
+
+def test_slug_dialect_unknown():
+    with pytest.raises(ValueError):
+        mdtoc.MdToc('markdown-it')
+
+def test_slug_engine_caches_results():
+    engine = mdtoc.SlugEngine()
+    engine.slugify("Parameters")
+    engine.slugify("Parameters")
+    assert engine.slugify.cache_info().hits == 1
+
+def test_iter_add_toc_matches_add_toc(mt):
+    lines = []
+    lines.append("# Title")
+    lines.append("## Contents")
+    lines.append("* [stale](#stale)")
+    lines.append("## header 1")
+    lines.append("{% highlight cpp %}")
+    lines.append("# comment")
+    lines.append("{% endhighlight %}")
+    lines.append("### header 2  ")
+    lines.append("word word word")
+
+    expect = mt.add_toc(list(lines), skip_headers=1)
+
+    output = list(mt.iter_add_toc(lambda: iter(lines), skip_headers=1))
+
+    assert expect == output
+
+def test_iter_add_toc_no_contents(mt):
+    lines = ["# header 1", "text"]
+    with pytest.raises(mdtoc.MissingContentsError):
+        mt.iter_add_toc(lambda: iter(lines))
+
+def test_add_toc_stream_file(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("## Contents\n## header 1\ntext\n")
+    path.chmod(0o640)
+
+    mdtoc.add_toc_stream_file(mt, str(path))
+
+    expect = '## Contents<a name="contents"></a>\n\n* [Contents](#contents)\n* [header 1](#header-1)\n\n## header 1<a name="header-1"></a>\ntext\n'
+    assert expect == path.read_text()
+    assert 0o640 == path.stat().st_mode & 0o777
+
+def test_filter_stdin(mt, mocker, capsys):
+    mocker.patch('sys.stdin', io.StringIO("## Contents\n## header 1\n"))
+
+    mdtoc.filter_stdin(mt)
+
+    expect = '## Contents<a name="contents"></a>\n\n* [Contents](#contents)\n* [header 1](#header-1)\n\n## header 1<a name="header-1"></a>\n'
+    assert expect == capsys.readouterr().out
+
+def test_rewrite_lines_no_contents(mt):
+    with pytest.raises(mdtoc.MissingContentsError):
+        mt.rewrite_lines(["# header 1", "text"])
+
+def test_collect_files(tmp_path):
+    (tmp_path / "docs" / "api").mkdir(parents=True)
+    (tmp_path / "docs" / "build").mkdir()
+    (tmp_path / "docs" / "a.md").write_text("")
+    (tmp_path / "docs" / "notes.txt").write_text("")
+    (tmp_path / "docs" / "api" / "b.md").write_text("")
+    (tmp_path / "docs" / "build" / "c.md").write_text("")
+    docs = str(tmp_path / "docs")
+
+    assert [docs + "/a.md"] == mdtoc.collect_files([docs])
+    assert [docs + "/a.md", docs + "/api/b.md"] == \
+        mdtoc.collect_files([docs], recursive=True, exclude=["build"])
+    assert [docs + "/a.md", docs + "/notes.txt"] == \
+        mdtoc.collect_files([docs], include=["*.md", "*.txt"])
+    assert [docs + "/api/b.md", docs + "/build/c.md"] == \
+        mdtoc.collect_files([docs + "/*/*.md", docs + "/api/b.md"])
+
+def test_run_batch_reports_errors_per_file(tmp_path):
+    good = tmp_path / "good.md"
+    good.write_text("## Contents\n## header 1\n")
+    done = tmp_path / "done.md"
+    done.write_text('## Contents<a name="contents"></a>\n\n* [Contents](#contents)\n\n')
+    bad = tmp_path / "bad.md"
+    bad.write_text("## header 1\n")
+    filenames = [str(good), str(done), str(bad), str(tmp_path / "missing.md")]
+
+    for jobs in [1, 2]:
+        good.write_text("## Contents\n## header 1\n")
+        results = list(mdtoc.run_batch(filenames, jobs))
+
+        assert ['changed', 'unchanged', 'failed', 'failed'] == [r.status for r in results]
+        assert 'Document does not contain header with name Contents' == results[2].error
+        assert '## header 1<a name="header-1"></a>\n' in good.read_text()
+        assert "## header 1\n" == bad.read_text()
+
+def test_report_results(capsys):
+    results = []
+    results.append(mdtoc.FileResult('a.md', 'changed', None, None, None, None))
+    results.append(mdtoc.FileResult('b.md', 'failed', 'boom', None, None, None))
+
+    counts = mdtoc.report_results(results)
+
+    captured = capsys.readouterr()
+    assert 1 == counts['failed']
+    assert 'ERROR: b.md: boom\n' == captured.err
+    assert '1 changed, 0 unchanged, 1 failed\n' == captured.out
+
+def test_content_cache_skips_unchanged_files(tmp_path, mocker):
+    path = tmp_path / "article.md"
+    path.write_text("## Contents\n## header 1\n")
+    cache_dir = str(tmp_path / ".mdtoc-cache")
+    fingerprint = mdtoc.ContentCache.make_fingerprint(skip_headers=0, slug_dialect='mdtoc')
+
+    cache = mdtoc.ContentCache(cache_dir, fingerprint).load()
+    assert ['changed'] == [r.status for r in mdtoc.run_batch([str(path)], cache=cache)]
+    cache.save()
+
+    spy = mocker.spy(mdtoc, 'process_file')
+    cache = mdtoc.ContentCache(cache_dir, fingerprint).load()
+    assert ['unchanged'] == [r.status for r in mdtoc.run_batch([str(path)], cache=cache)]
+    assert 0 == spy.call_count
+
+    # Same content with a new mtime is recognised by its digest
+    os.utime(str(path), ns=(0, 0))
+    rewrite = mocker.spy(mdtoc, 'add_toc_file')
+    assert ['unchanged'] == [r.status for r in mdtoc.run_batch([str(path)], cache=cache)]
+    assert 0 == rewrite.call_count
+    assert 0 == cache.lookup(str(path))[1]
+
+def test_cache_option_does_not_take_a_path(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["mdtoc.py", "--cache", "article.md"])
+    args = mdtoc.parse_command_line_arguments()
+    assert args.cache is True
+    assert ["article.md"] == args.paths
+    assert ".mdtoc-cache" == args.cache_dir
+
+def test_content_cache_invalidated_by_options(tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("## Contents\n## header 1\n")
+    cache_dir = str(tmp_path / ".mdtoc-cache")
+
+    fingerprint = mdtoc.ContentCache.make_fingerprint(skip_headers=0, slug_dialect='mdtoc')
+    cache = mdtoc.ContentCache(cache_dir, fingerprint).load()
+    list(mdtoc.run_batch([str(path)], cache=cache))
+    cache.save()
+
+    fingerprint = mdtoc.ContentCache.make_fingerprint(skip_headers=1, slug_dialect='mdtoc')
+    cache = mdtoc.ContentCache(cache_dir, fingerprint).load()
+    assert cache.lookup(str(path)) is None
+
+def test_write_file_skips_identical_output(tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("text\n")
+    os.utime(str(path), ns=(0, 0))
+
+    assert mdtoc.write_file(str(path), "text\n", "text\n") is False
+    assert 0 == path.stat().st_mtime_ns
+
+def test_write_file_atomic_replace(tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("old\n")
+    path.chmod(0o604)
+
+    assert mdtoc.write_file(str(path), "new\n", "old\n") is True
+    assert "new\n" == path.read_text()
+    assert 0o604 == path.stat().st_mode & 0o777
+    assert ["article.md"] == os.listdir(str(tmp_path))
+
+def test_common_prefix_length():
+    assert 0 == mdtoc.common_prefix_length("", "abc")
+    assert 3 == mdtoc.common_prefix_length("abc", "abcd")
+    for block_size in [1, 2, 4, 100]:
+        assert 5 == mdtoc.common_prefix_length("abcdefgh", "abcdeXgh", block_size)
+
+def test_write_file_tail_in_place(tmp_path):
+    path = tmp_path / "article.md"
+    path.write_bytes(b"# Title\r\nold text\r\n")
+    inode = path.stat().st_ino
+
+    assert mdtoc.write_file(str(path), "# Title\nnew\n", "# Title\nold text\n", "\r\n", in_place=True) is True
+    assert b"# Title\r\nnew\r\n" == path.read_bytes()
+    assert inode == path.stat().st_ino
+    assert mdtoc.write_file_tail(str(path), "# Title\nnewer\n", "# Title\nchanged on disk\n") is False
+
+    # Same size, but modified after it was read
+    mtime_ns = path.stat().st_mtime_ns
+    os.utime(str(path), ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert mdtoc.write_file_tail(str(path), "# Title\nold\n", "# Title\nnew\n", "\r\n", mtime_ns) is False
+    assert b"# Title\r\nnew\r\n" == path.read_bytes()
+
+def test_add_toc_file_rewrites_in_place_unless_atomic(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("# Contents\n# Header\n")
+    inode = path.stat().st_ino
+    assert mdtoc.add_toc_file(mt, str(path)) is True
+    assert inode == path.stat().st_ino
+
+    path.write_text("# Contents\n# Other\n")
+    assert mdtoc.add_toc_file(mt, str(path), atomic=True) is True
+    assert inode != path.stat().st_ino
+    assert ["article.md"] == os.listdir(str(tmp_path))
+
+def test_update_file_reports_read_only_files(mt, tmp_path, monkeypatch):
+    path = tmp_path / "ro.md"
+    path.write_text("## Contents\n")
+    path.chmod(0o444)
+    # Root may write to read-only files, so access is checked by the mode
+    monkeypatch.setattr(mdtoc.os, "access", lambda filename, mode: os.stat(filename).st_mode & 0o222 != 0)
+
+    for atomic in [False, True]:
+        result = mdtoc.update_file(mt, str(path), atomic=atomic)
+        assert 'failed' == result.status
+        assert 'Permission denied' in result.error
+        assert "## Contents\n" == path.read_text()
+
+def test_add_toc_file_mixed_newlines_replaced_atomically(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_bytes(b"# Contents\r\n# Header\n")
+    inode = path.stat().st_ino
+    assert mdtoc.add_toc_file(mt, str(path)) is True
+    assert inode != path.stat().st_ino
+    assert b"\n" not in path.read_bytes().replace(b"\r\n", b"")
+
+def test_write_file_follows_symlinks(mt, tmp_path):
+    (tmp_path / "real").mkdir()
+    target = tmp_path / "real" / "doc.md"
+    target.write_text("## Contents\n## header 1\n")
+    link = tmp_path / "link.md"
+    link.symlink_to(target)
+
+    assert mdtoc.add_toc_file(mt, str(link), atomic=True) is True
+    assert link.is_symlink()
+    assert '## header 1<a name="header-1"></a>' in target.read_text()
+
+    target.write_text("## Contents\n## header 2\n")
+    assert mdtoc.add_toc_stream_file(mt, str(link)) is True
+    assert link.is_symlink()
+    assert '## header 2<a name="header-2"></a>' in target.read_text()
+    assert ["doc.md"] == os.listdir(str(tmp_path / "real"))
+
+def test_add_toc_file_preserves_crlf(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_bytes(b"## Contents\r\n## header 1\r\n")
+
+    assert mdtoc.add_toc_file(mt, str(path)) is True
+    expect = b'## Contents<a name="contents"></a>\r\n\r\n* [Contents](#contents)\r\n* [header 1](#header-1)\r\n\r\n## header 1<a name="header-1"></a>\r\n'
+    assert expect == path.read_bytes()
+    assert mdtoc.add_toc_file(mt, str(path)) is False
+    assert mdtoc.add_toc_stream_file(mt, str(path)) is False
+
+def test_add_toc_stream_file_failure_leaves_file(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("## header 1\n")
+
+    with pytest.raises(mdtoc.MissingContentsError):
+        mdtoc.add_toc_stream_file(mt, str(path))
+    assert "## header 1\n" == path.read_text()
+    assert ["article.md"] == os.listdir(str(tmp_path))
+
+def test_check_lines_up_to_date(mt):
+    lines = mt.add_toc(["# Title", "## Contents", "## header 1", "text", "## header 2"], skip_headers=1)
+    assert mt.check_lines(lines, skip_headers=1) is None
+
+def test_check_lines_missing_anchor(mt):
+    lines = mt.add_toc(["## Contents", "## header 1", "text"])
+    lines.append("## header 2")
+    assert (8, 'header has no anchor tag') == mt.check_lines(lines)
+
+def test_check_lines_stale_toc(mt):
+    lines = mt.add_toc(["## Contents", "## header 1", "text"])
+    lines[3] = "* [header one](#header-1)"
+    assert (4, 'table of contents is out of date') == mt.check_lines(lines)
+
+def test_check_lines_extra_lines_in_contents(mt):
+    lines = mt.add_toc(["## Contents", "## header 1", "text"])
+    lines.insert(5, "leftover")
+    assert (6, 'table of contents is out of date') == mt.check_lines(lines)
+
+def test_check_file_with_diff(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("## Contents\n## header 1\n")
+
+    result = mdtoc.process_file(str(path), check=True, diff=True)
+
+    assert 'stale' == result.status
+    assert 'line 1: header has no anchor tag' == result.error
+    assert '+## header 1<a name="header-1"></a>\n' in result.details
+    assert "## Contents\n## header 1\n" == path.read_text()
+
+def test_diff_requires_check(monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["mdtoc.py", "--diff", "article.md"])
+    with pytest.raises(SystemExit):
+        mdtoc.parse_command_line_arguments()
+    assert "--diff requires --check" in capsys.readouterr().err
+
+def test_stats_counters():
+    stats = mdtoc.Stats()
+    mt = mdtoc.MdToc(stats=stats)
+    lines = []
+    lines.append("## Contents")
+    lines.append("## Example")
+    lines.append("{% highlight cpp %}")
+    lines.append("# comment")
+    lines.append("{% endhighlight %}")
+    lines.append("## Example")
+
+    mt.add_toc(lines)
+
+    counters = stats.as_dict()['counters']
+    assert 6 == counters['lines_scanned']
+    assert 3 == counters['headers_found']
+    assert 1 == counters['headers_skipped_in_blocks']
+    assert 3 == counters['slugs_generated']
+    assert 1 == counters['duplicate_collisions']
+    assert ['assemble_lines', 'generate_tags', 'generate_toc', 'parse_headers'] == sorted(stats.timings)
+
+def test_stats_aggregate_across_files(tmp_path):
+    filenames = []
+    for name in ["a.md", "b.md"]:
+        path = tmp_path / name
+        path.write_text("## Contents\n## header 1\n")
+        filenames.append(str(path))
+    stats = mdtoc.Stats()
+
+    mdtoc.report_results(mdtoc.run_batch(filenames, stats=True), summary=False, stats=stats)
+
+    counters = stats.as_dict()['counters']
+    assert 2 == counters['files']
+    assert 4 == counters['headers_found']
+    assert 2 * len("## Contents\n## header 1\n") == counters['bytes_read']
+    assert counters['bytes_written'] > counters['bytes_read']
+    assert stats.timings['total'] > 0
+
+def test_stats_count_files_skipped_by_cache(tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("## Contents\n## header 1\n")
+    cache_dir = str(tmp_path / ".mdtoc-cache")
+    fingerprint = mdtoc.ContentCache.make_fingerprint(skip_headers=0, slug_dialect='mdtoc')
+    cache = mdtoc.ContentCache(cache_dir, fingerprint).load()
+    list(mdtoc.run_batch([str(path)], cache=cache))
+
+    stats = mdtoc.Stats()
+    mdtoc.report_results(mdtoc.run_batch([str(path)], cache=cache, stats=True), summary=False, stats=stats)
+    # Same content with a new mtime is only recognised by its digest
+    os.utime(str(path), ns=(0, 0))
+    mdtoc.report_results(mdtoc.run_batch([str(path)], cache=cache, stats=True), summary=False, stats=stats)
+
+    counters = stats.as_dict()['counters']
+    assert 2 == counters['files']
+    assert 2 == counters['files_cached']
+    assert 0 == counters['bytes_written']
+
+def test_watcher_updates_changed_files_once(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("## Contents\n## header 1\n")
+    other = tmp_path / "other.md"
+    other.write_text("## Contents\n")
+    watcher = mdtoc.Watcher([str(tmp_path)], mt, debounce=0)
+    watcher.start()
+
+    assert [] == watcher.poll()
+
+    path.write_text("## Contents\n## header 1\n## header 2\n")
+    results = watcher.poll()
+
+    assert [(str(path), 'changed')] == [(r.filename, r.status) for r in results]
+    assert '* [header 2](#header-2)' in path.read_text()
+    assert 3 == len(watcher.documents[str(path)].records)
+    assert [] == watcher.poll()
+
+    path.write_text(path.read_text() + "text\n")
+    assert ['unchanged'] == [r.status for r in watcher.poll()]
+    assert path.read_text() == ''.join(line + '\n' for line in watcher.documents[str(path)].lines)
+
+def test_document_replace(mt):
+    document = mdtoc.Document(["# Contents", "text", "# A", "text", "# B"], mt)
+    assert 2 == document.replace(["# Contents", "text", "# A", "more", "# B"])
+    assert 3 == document.replace(["# Contents", "text", "# A", "more", "---", "# B"])
+    assert mt.tokenize_headers(document.lines) == document.records
+
+def test_watcher_debounces_changes(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_text("## Contents\n")
+    watcher = mdtoc.Watcher([str(tmp_path)], mt, debounce=1.0)
+    watcher.start()
+
+    path.write_text("## Contents\n## header 1\n")
+    assert [] == watcher.poll(now=10.0)
+    assert [] == watcher.poll(now=10.5)
+    assert ['changed'] == [r.status for r in watcher.poll(now=11.0)]
+
+def test_document_matches_full_parse_after_edits(mt):
+    rng = random.Random(1)
+    choices = ["# header a", "## header b", "text", "", "{% highlight cpp %}", "{% endhighlight %}",
+               '### tagged<a name="tagged"></a>']
+    lines = [rng.choice(choices) for _ in range(200)]
+    document = mdtoc.Document(lines, mt)
+
+    for _ in range(300):
+        start = rng.randint(0, len(lines))
+        end = rng.randint(start, min(len(lines), start + 5))
+        new_lines = [rng.choice(choices) for _ in range(rng.randint(0, 5))]
+        lines[start:end] = new_lines
+        document.edit(start, end, new_lines)
+
+        assert lines == document.lines
+        assert mt.tokenize_headers(lines) == document.records
+
+def test_document_edit_reparses_only_until_state_matches(mt):
+    lines = ["## Contents"] + ["text"] * 1000 + ["## header 1"]
+    document = mdtoc.Document(lines, mt)
+
+    # The line before, and the text lines whose paragraph state changes
+    assert 4 == document.edit(500, 501, ["## header 0"])
+    assert ["Contents", "header 0", "header 1"] == [r.title for r in document.records]
+
+    reparsed = document.edit(10, 10, ["{% highlight cpp %}"])
+    assert reparsed == len(document.lines) - 9
+    assert ["Contents"] == [r.title for r in document.records]
+
+    document.edit(20, 20, ["{% endhighlight %}"])
+    assert ["Contents", "header 0", "header 1"] == [r.title for r in document.records]
+    assert 1004 == document.records[-1].line
+
+def test_document_toc_and_rewrite(mt):
+    document = mdtoc.Document(["## Contents", "## header 1"], mt)
+    document.edit(2, 2, ["## header 1"])
+
+    assert ["* [Contents](#contents)", "* [header 1](#header-1)", "* [header 1](#header-1-2)"] == document.toc()
+    assert mt.add_toc(list(document.lines)) == document.rewrite()
+
+def splice_document():
+    lines = []
+    lines.append("# Title")
+    lines.append("## Contents")
+    lines.append("* [stale](#stale)")
+    lines.append("")
+    lines.append("## header å  ")
+    lines.append("{% highlight cpp %}")
+    lines.append("# comment")
+    lines.append("{% endhighlight %}")
+    lines.append('### header 2<a name="header-2"></a>')
+    lines.append("#not a header")
+    lines.append("text")
+    return lines
+
+def test_scan_buffer_matches_tokenize_headers(mt):
+    lines = splice_document()
+    data = '\n'.join(lines).encode('utf-8')
+
+    scanned = mt.scan_buffer(data)
+
+    assert mt.tokenize_headers(lines) == [item.record for item in scanned]
+    assert [data[item.start:item.end].decode('utf-8') for item in scanned] == \
+        [lines[item.record.line - 1] for item in scanned]
+    assert [item.record for item in scanned] == [item.record for item in mt.scan_buffer(memoryview(data))]
+
+def test_iter_splice_buffer_matches_add_toc(mt):
+    lines = splice_document()
+    expect = ''.join(line + '\n' for line in mt.add_toc(list(lines), skip_headers=1)).encode('utf-8')
+
+    for newline in ['\n', '\r\n']:
+        data = ''.join(line + newline for line in lines).encode('utf-8')
+        output = b''.join(mt.iter_splice_buffer(data, skip_headers=1))
+        assert expect.replace(b'\n', newline.encode()) == output
+
+def test_iter_splice_buffer_mmap(mt, tmp_path):
+    path = tmp_path / "article.md"
+    path.write_bytes(b"## Contents\nold toc\n## header 1\ntext\n")
+
+    with open(str(path), 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            output = b''.join(mt.iter_splice_buffer(buffer))
+
+    expect = b'## Contents<a name="contents"></a>\n\n* [Contents](#contents)\n* [header 1](#header-1)\n\n## header 1<a name="header-1"></a>\ntext\n'
+    assert expect == output
+
+def test_iter_splice_buffer_no_contents(mt):
+    with pytest.raises(mdtoc.MissingContentsError):
+        list(mt.iter_splice_buffer(b"# header\n"))
+
+def test_parse_headers_skips_fenced_blocks(mt):
+    lines = []
+    lines.append("# header 1")
+    lines.append("````python")
+    lines.append("# comment")
+    lines.append("```")
+    lines.append("# still code")
+    lines.append("````")
+    lines.append("~~~")
+    lines.append("# tilde code")
+    lines.append("~~~")
+    lines.append("## header 2")
+
+    assert ['header 1', 'header 2'] == [h['header'] for h in mt.parse_headers(lines)]
+
+def test_parse_headers_skips_liquid_html_and_front_matter(mt):
+    lines = []
+    lines.append("---")
+    lines.append("# yaml comment")
+    lines.append("---")
+    lines.append("{% raw %}")
+    lines.append("# raw")
+    lines.append("{% endraw %}")
+    lines.append("<div>")
+    lines.append("# inside html")
+    lines.append("")
+    lines.append("<!--")
+    lines.append("# commented out")
+    lines.append("-->")
+    lines.append("<pre>")
+    lines.append("")
+    lines.append("# preformatted")
+    lines.append("</pre>")
+    lines.append("    # indented code")
+    lines.append("# header 1")
+
+    assert [('header 1', 18)] == [(h['header'], h['line']) for h in mt.parse_headers(lines)]
+
+def test_parse_headers_one_line_liquid_blocks(mt):
+    lines = ["# Contents", "{% comment %}x{% endcomment %}", "# A", "{% raw %}{{ x }}{% endraw %}", "# B",
+             "{% raw %}{% endcomment %}", "# not a header", "{% endraw %}", "# C"]
+    assert ['Contents', 'A', 'B', 'C'] == [h['header'] for h in mt.parse_headers(lines)]
+    data = '\n'.join(lines).encode('utf-8')
+    assert mt.tokenize_headers(lines) == [item.record for item in mt.scan_buffer(data)]
+
+def test_add_toc_leaves_fenced_block_alone(mt):
+    lines = []
+    lines.append("## Contents")
+    lines.append("```bash")
+    lines.append("# Contents")
+    lines.append("```")
+    lines.append("## header 1")
+
+    expect = []
+    expect.append('## Contents<a name="contents"></a>')
+    expect.append('')
+    expect.append("* [Contents](#contents)")
+    expect.append("* [header 1](#header-1)")
+    expect.append('')
+    expect.append('## header 1<a name="header-1"></a>')
+
+    assert expect == mt.add_toc(lines)
+
+def test_scan_buffer_matches_parse_headers_on_random_documents(mt):
+    rng = random.Random(2)
+    choices = ["# header", "## other", "text", "", "```", "````", "~~~", "{% highlight c %}", "{% endhighlight %}",
+               "<div>", "<pre>", "</pre>", "<!-- x", "-->", "<!-- y -->", "    # indented", "---", "{% raw %}",
+               "{% endraw %}", "## Contents", "Title", "Contents", "===", "- item", "## Closed ##", "***"]
+    for _ in range(500):
+        lines = [rng.choice(choices) for _ in range(rng.randint(1, 30))]
+        data = '\n'.join(lines).encode('utf-8')
+        assert mt.tokenize_headers(lines) == [item.record for item in mt.scan_buffer(data)]
+        if any(record.title == 'Contents' for record in mt.tokenize_headers(lines)):
+            expect = ''.join(line + '\n' for line in mt.rewrite_lines(list(lines))).encode('utf-8')
+            assert expect == b''.join(mt.iter_splice_buffer(data + b'\n'))
+
+def test_rewrite_lines_does_not_mutate_input(mt):
+    lines = ["## Contents", "old toc", "## header 1", "text"]
+    copy = list(lines)
+
+    output = mt.rewrite_lines(lines)
+
+    assert copy == lines
+    assert ['## Contents<a name="contents"></a>', '', '* [Contents](#contents)', '* [header 1](#header-1)', '',
+            '## header 1<a name="header-1"></a>', 'text'] == output
+
+def test_add_anchor_tags_does_not_mutate_input(mt):
+    lines = ["## header 1", "text"]
+    headers = mt.generate_tags(mt.parse_headers(lines))
+
+    assert ['## header 1<a name="header-1"></a>', 'text'] == mt.add_anchor_tags(lines, headers)
+    assert ["## header 1", "text"] == lines
+
+def test_assemble_lines_matches_insert_toc(mt):
+    lines = []
+    lines.append("# Title")
+    lines.append("## Contents")
+    lines.append("stale")
+    lines.append("```")
+    lines.append("# code")
+    lines.append("```")
+    lines.append("## header 1")
+    lines.append("## Contents")
+    headers = mt.generate_tags(mt.parse_headers(lines))
+    toc = mt.generate_toc(headers, skip_headers=1)
+
+    expect = mt.insert_toc(mt.add_anchor_tags(lines, headers), toc)
+
+    assert expect == mt.assemble_lines(lines, headers, toc)
+    assert expect == list(mt.iter_splice_lines(iter(lines), headers, toc))
+
+def test_respond_rewrite_and_headers():
+    request = {'id': 7, 'text': "## Contents\n## header 1\n"}
+
+    response = mdtoc.respond(json.dumps(request))
+
+    assert 7 == response['id']
+    assert response['ok'] is True
+    assert response['text'].startswith('## Contents<a name="contents"></a>\n')
+
+    response = mdtoc.respond(json.dumps(dict(request, action='headers')))
+    assert ['Contents', 'header 1'] == [h['header'] for h in response['headers']]
+
+def test_serve_stdio_from_regular_file(tmp_path):
+    requests = tmp_path / "requests.ndjson"
+    requests.write_text(json.dumps({'id': 1, 'text': "## Contents\n## header 1\n"}) + '\n')
+
+    with open(str(requests)) as f_in:
+        process = subprocess.run([sys.executable, mdtoc.__file__, 'serve', '--stdio'], stdin=f_in,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    assert b'' == process.stderr
+    response = json.loads(process.stdout.decode('utf-8'))
+    assert 1 == response['id'] and response['ok'] is True
+
+def test_respond_errors():
+    assert {'ok': False, 'error': 'Document does not contain header with name Contents'} == \
+        mdtoc.respond('{"text": "# header"}')
+    assert mdtoc.respond('not json')['ok'] is False
+    assert 'Request must contain text or path' == mdtoc.respond('{}')['error']
+
+def test_serve_unix_socket(tmp_path):
+    socket_path = str(tmp_path / "mdtoc.sock")
+    document = tmp_path / "article.md"
+    document.write_text("## Contents\n## header 1\n")
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(mdtoc.start_unix_server(socket_path))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    try:
+        requests = []
+        requests.append({'path': str(document), 'write': True})
+        requests.append({'text': "# no contents\n"})
+        requests.append({'text': "## Contents\n", 'slug_dialect': 'github'})
+        responses = mdtoc.client_requests(socket_path, requests)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+    assert [True, False, True] == [r['ok'] for r in responses]
+    assert responses[0]['changed'] is True
+    assert '## header 1<a name="header-1"></a>\n' in document.read_text()
+
+def test_serve_keeps_existing_file_at_socket_path(tmp_path, capsys):
+    path = tmp_path / "notasocket"
+    path.write_text("important")
+
+    with pytest.raises(SystemExit) as e:
+        mdtoc.serve_main(['--socket', str(path)])
+
+    assert 1 == e.value.code
+    assert "is not a socket" in capsys.readouterr().err
+    assert "important" == path.read_text()
+
+def test_site_index_updates_only_changed_files(tmp_path):
+    (tmp_path / "docs" / "api").mkdir(parents=True)
+    a = tmp_path / "docs" / "a.md"
+    a.write_text("# A\n## Contents\n## Usage\n")
+    b = tmp_path / "docs" / "api" / "b.md"
+    b.write_text('## B<a name="bee"></a>\n### Usage\n')
+    filenames = [str(a), str(b)]
+    db = str(tmp_path / "index.sqlite")
+
+    site_index = mdtoc.SiteIndex(db)
+    assert 2 == site_index.update(filenames)['updated']
+    site_index.close()
+
+    b.write_text('## B<a name="bee"></a>\n### Usage\n### Returns\n')
+    site_index = mdtoc.SiteIndex(db)
+    counts = site_index.update(filenames)
+    assert (1, 1) == (counts['updated'], counts['unchanged'])
+
+    expect = []
+    expect.append("* [docs/a.md](docs/a.md)")
+    expect.append("    * [A](docs/a.md#a)")
+    expect.append("        * [Usage](docs/a.md#usage)")
+    expect.append("* [docs/api/b.md](docs/api/b.md)")
+    expect.append("    * [B](docs/api/b.md#bee)")
+    expect.append("        * [Usage](docs/api/b.md#usage)")
+    expect.append("        * [Returns](docs/api/b.md#returns)")
+    assert expect == site_index.generate_toc(str(tmp_path / "SITE.md"))
+
+    assert 1 == site_index.update([str(a)])['removed']
+    assert 3 == len(site_index.generate_toc(str(tmp_path / "SITE.md")))
+    site_index.close()
+
+def test_site_index_reset_when_slug_dialect_changes(tmp_path):
+    a = tmp_path / "a.md"
+    a.write_text("# A & B\n")
+    db = str(tmp_path / "index.sqlite")
+
+    site_index = mdtoc.SiteIndex(db)
+    site_index.update([str(a)])
+    site_index.close()
+
+    site_index = mdtoc.SiteIndex(db, 'github')
+    assert 1 == site_index.update([str(a)])['updated']
+    assert ["* [a.md](a.md)", "    * [A & B](a.md#a--b)"] == site_index.generate_toc(str(tmp_path / "SITE.md"))
+    site_index.close()
+
+def test_parse_links(mt):
+    lines = ["# Title",
+             "See [a](#a) and [b](b.md#b \"title\") but not `[c](#c)`.",
+             "```",
+             "[d](#d)",
+             "```",
+             "[e]: other.md#e"]
+    assert [(2, '#a'), (2, 'b.md#b'), (6, 'other.md#e')] == mt.parse_links(lines)
+
+def test_site_index_broken_links(tmp_path):
+    (tmp_path / "docs").mkdir()
+    a = tmp_path / "docs" / "a.md"
+    a.write_text("# Intro\n# Intro\n[ok](#intro-2) [bad](#outro)\n[ok](../b.md#usage) [bad](../b.md#missing)\n")
+    b = tmp_path / "b.md"
+    b.write_text("## Usage<a name=\"usage\"></a>\n[ok](docs/a.md) [bad](c.md) [ok](https://example.com/#x)\n")
+    db = str(tmp_path / "index.sqlite")
+
+    site_index = mdtoc.SiteIndex(db)
+    site_index.update([str(a), str(b)])
+    expect = [('b.md', 2, 'c.md', 'file not found'),
+              ('docs/a.md', 3, '#outro', 'anchor not found'),
+              ('docs/a.md', 4, '../b.md#missing', 'anchor not found')]
+    assert expect == site_index.broken_links()
+
+    b.write_text("## Usage<a name=\"usage\"></a>\n## Missing\n")
+    site_index.update([str(a), str(b)])
+    assert [('docs/a.md', 3, '#outro', 'anchor not found')] == site_index.broken_links()
+    site_index.close()
+
+def test_links_main_exits_non_zero_on_broken_links(tmp_path, capsys):
+    a = tmp_path / "a.md"
+    a.write_text("# Title\n[x](#nothing)\n")
+    db = str(tmp_path / "index.sqlite")
+
+    with pytest.raises(SystemExit) as e:
+        mdtoc.links_main([str(a), '--db', db])
+    assert 1 == e.value.code
+    assert "a.md:2: anchor not found: #nothing" in capsys.readouterr().out
+
+    a.write_text("# Title\n[x](#title)\n")
+    mdtoc.links_main([str(a), '--db', db])
+
+def test_links_main_keeps_other_indexed_files(tmp_path, capsys):
+    a = tmp_path / "a.md"
+    a.write_text("# A\n[x](b.md#usage)\n")
+    b = tmp_path / "b.md"
+    b.write_text("# Usage\n[x](#missing)\n")
+    db = str(tmp_path / "index.sqlite")
+    mdtoc.index_main([str(a), str(b), '--db', db])
+
+    b.write_text("# Usage\n# Other\n")
+    mdtoc.links_main([str(a), '--db', db])
+    assert "0 broken links in 1 files" in capsys.readouterr().out
+
+    site_index = mdtoc.SiteIndex(db)
+    assert {'a.md', 'b.md'} == set(path for path, in site_index.connection.execute("SELECT path FROM files"))
+    assert ('b.md', 'other') in set(site_index.connection.execute("SELECT path, anchor FROM headers"))
+    site_index.close()
+
+    b.unlink()
+    with pytest.raises(SystemExit):
+        mdtoc.links_main([str(a), '--db', db])
+    assert "file not found" in capsys.readouterr().out
+
+def test_emit_index_ndjson_does_not_modify_files(tmp_path):
+    a = tmp_path / "a.md"
+    text = "# Contents\n## Usage<a name=\"usage\"></a>\n## Usage\n"
+    a.write_text(text)
+    f_out = io.StringIO()
+
+    assert 0 == mdtoc.emit_index([str(a)], 'ndjson', f_out=f_out)
+    records = [json.loads(line) for line in f_out.getvalue().splitlines()]
+    assert {'file': str(a), 'line': 3, 'level': 2, 'title': 'Usage', 'tag': None, 'new_tag': 'usage-2'} == records[2]
+    assert 'usage' == records[1]['tag'] and records[1]['new_tag'] is None
+    assert text == a.read_text()
+
+def test_emit_index_json(tmp_path):
+    a = tmp_path / "a.md"
+    a.write_text("# A\n")
+    b = tmp_path / "b.md"
+    b.write_text("# B\n")
+    f_out = io.StringIO()
+
+    assert 1 == mdtoc.emit_index([str(a), str(tmp_path / "missing.md"), str(b)], 'json', f_out=f_out)
+    assert ['a', 'b'] == [record['new_tag'] for record in json.loads(f_out.getvalue())]
+
+    f_out = io.StringIO()
+    mdtoc.emit_index([], 'json', f_out=f_out)
+    assert [] == json.loads(f_out.getvalue())
+
+def test_header_store_matches_header_dicts(mt):
+    lines = ["# Contents",
+             "## Usage",
+             "## Usage<a name=\"usage-2\"></a>",
+             "### Usage",
+             "```",
+             "# not a header",
+             "```",
+             "## Example"]
+    headers = mt.generate_tags(mt.parse_headers(lines))
+    store = mt.generate_tags(mt.parse_header_store(lines))
+
+    assert 5 == len(store)
+    assert [dict(header) for header in headers] == [{key: header[key] for key in header.keys()} for header in store]
+    assert 'usage-3' == store[3]['new_tag']
+    assert 8 == store[-1]['line']
+    assert mt.header_level_min(headers) == mt.header_level_min(store)
+    assert mt.generate_toc(headers, 1) == mt.generate_toc(store, 1)
+    assert mt.add_anchor_tags(lines, headers) == mt.add_anchor_tags(lines, store)
+    assert mt.assemble_lines(lines, headers, mt.generate_toc(headers)) == mt.assemble_lines(lines, store, mt.generate_toc(store))
+
+def test_tokenize_header_anchor_of_any_length(mt):
+    tag = 'a' * 1000
+    assert mdtoc.HeaderRecord(2, 'Title', tag, 1) == mt.tokenize_header('## Title<a name="' + tag + '"></a>', 1)
+
+def test_tokenize_header_leftmost_anchor_tag(mt):
+    assert mdtoc.HeaderRecord(1, 'A', 'a', None) == mt.tokenize_header('# A<a name="a"></a><a name="b"></a>')
+    assert mdtoc.HeaderRecord(1, 'A<a name=></a>', None, None) == mt.tokenize_header('# A<a name=></a>')
+    assert mdtoc.HeaderRecord(1, 'A<a name="a"></a> ', None, None) == mt.tokenize_header('# A<a name="a"></a> ')
+
+def test_is_header_setext_and_closed(mt):
+    assert mt.is_header("## Closed ##") is True
+    assert mt.is_header("Title", "=====") is True
+    assert mt.is_header("Title", "---") is True
+    assert mt.is_header("Title") is False
+    assert mt.is_header("- item", "---") is False
+    assert mt.is_header("", "---") is False
+
+def test_parse_headers_setext_and_closed(mt):
+    lines = ["Title",
+             "=====",
+             "",
+             "## Closed ##",
+             "### C# ###",
+             "#### C#",
+             "paragraph",
+             "continued",
+             "---",
+             "- item",
+             "---",
+             "Subtitle<a name=\"sub\"></a>",
+             "--------",
+             "```",
+             "Code",
+             "---",
+             "```"]
+
+    expect = [('Title', 1, 1), ('Closed', 2, 4), ('C#', 3, 5), ('C#', 4, 6), ('Subtitle', 2, 12)]
+    assert expect == [(h['header'], h['level'], h['line']) for h in mt.parse_headers(lines)]
+    assert 'sub' == mt.parse_headers(lines)[-1]['tag']
+
+def test_add_toc_setext_and_closed(mt):
+    lines = ["Contents",
+             "========",
+             "old toc",
+             "## Usage ##",
+             "Example",
+             "-------"]
+
+    expect = ['Contents<a name="contents"></a>',
+              '========',
+              '',
+              '* [Contents](#contents)',
+              '    * [Usage](#usage)',
+              '    * [Example](#example)',
+              '',
+              '## Usage<a name="usage"></a> ##',
+              'Example<a name="example"></a>',
+              '-------']
+    assert expect == mt.add_toc(lines)
+    assert expect == mt.add_toc(expect)
+    assert mt.check_lines(expect) is None
+
+    headers = mt.generate_tags(mt.parse_headers(lines))
+    assert expect == mt.insert_toc(mt.add_anchor_tags(lines, headers), mt.generate_toc(headers))
+    assert expect == list(mt.iter_add_toc(lambda: iter(lines)))
+    data = ''.join(line + '\n' for line in lines).encode()
+    assert ''.join(line + '\n' for line in expect).encode() == b''.join(mt.iter_splice_buffer(data))
+
+def test_add_toc_empty_closed_headers_is_idempotent(mt):
+    output = mt.add_toc(["# Contents", "# #", "## ##"])
+    assert ['# #<a name="#"></a>', '## ##<a name="##"></a>'] == output[-2:]
+    assert ['* [#](##)', '    * [##](###)'] == output[3:5]
+    assert output == mt.add_toc(list(output))
+
+def test_document_edit_underline(mt):
+    document = mdtoc.Document(["## Contents", "Title", "text"], mt)
+    document.edit(2, 3, ["====="])
+    assert ["Contents", "Title"] == [record.title for record in document.records]
+    document.edit(2, 3, ["text"])
+    assert ["Contents"] == [record.title for record in document.records]
+
+def git(*arguments):
+    subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(arguments),
+                   check=True, stdout=subprocess.PIPE)
+
+def test_git_changed_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "docs" / "build").mkdir(parents=True)
+    for name in ["docs/a.md", "docs/b.md", "docs/notes.txt", "docs/build/c.md", "top.md"]:
+        (tmp_path / name).write_text("# Contents\n")
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+    for name in ["docs/a.md", "docs/notes.txt", "docs/build/c.md", "top.md"]:
+        (tmp_path / name).write_text("# Contents\n# Header\n")
+    git("add", "docs/a.md")
+    git("rm", "-q", "docs/b.md")
+
+    assert ["docs/a.md"] == mdtoc.git_changed_files(["docs"], staged=True)
+    changed = mdtoc.git_changed_files(["docs"], changed_since="HEAD")
+    assert ["docs/a.md", "docs/build/c.md", "docs/notes.txt"] == changed
+    assert ["docs/a.md"] == mdtoc.select_changed_files(changed, ["docs"])
+    assert ["docs/a.md", "docs/build/c.md"] == mdtoc.select_changed_files(changed, ["docs"], recursive=True)
+    assert ["docs/a.md"] == mdtoc.select_changed_files(changed, ["docs"], recursive=True, exclude=["build"])
+    changed = mdtoc.git_changed_files(["docs/*.txt"], changed_since="HEAD")
+    assert ["docs/notes.txt"] == mdtoc.select_changed_files(changed, ["docs/*.txt"])
+
+def test_main_staged_restages_rewritten_files(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a.md").write_text("# Contents\n")
+    (tmp_path / "b.md").write_text("# Contents\n")
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+    (tmp_path / "a.md").write_text("# Contents\n# Header\n")
+    (tmp_path / "b.md").write_text("# Contents\n# Header\n")
+    git("add", "a.md")
+
+    monkeypatch.setattr(sys, "argv", ["mdtoc.py", "--staged", "."])
+    mdtoc.main()
+
+    assert "# Contents\n# Header\n" == (tmp_path / "b.md").read_text()
+    staged = subprocess.run(['git', 'diff', '--cached', '--name-only'], stdout=subprocess.PIPE).stdout.decode()
+    unstaged = subprocess.run(['git', 'diff', '--name-only'], stdout=subprocess.PIPE).stdout.decode()
+    assert "a.md\n" == staged
+    assert "b.md\n" == unstaged
+    assert "# Header<a name=\"header\"></a>" in (tmp_path / "a.md").read_text()
+
+def test_parse_headers_parallel_matches_parse_headers(mt):
+    rng = random.Random(3)
+    choices = ["# header", "## other", "text", "", "```", "~~~", "{% highlight c %}", "# comment",
+               "{% endhighlight %}", "<pre>", "</pre>", "---", "Title", "===", "- item", "## Closed ##"]
+    lines = [rng.choice(choices) for _ in range(600)]
+    text = '\n'.join(lines)
+    assert 2 == len(mdtoc.split_text_chunks("a\nb\nc", 2))
+    for chunk_size in [40, 300, 1000]:
+        store = mdtoc.parse_headers_parallel(mt, text, lines, 4, chunk_size, 3)
+        assert mt.tokenize_headers(lines) == list(zip(store.levels, store.titles, store.tags, store.lines))
+
+    expect = mt.stats = mdtoc.Stats()
+    mt.parse_headers(lines)
+    got = mt.stats = mdtoc.Stats()
+    mdtoc.parse_headers_parallel(mt, text, lines, 4, 300, 3)
+    mt.stats = None
+    assert expect.counters == got.counters
+
+def test_add_toc_file_scan_jobs(tmp_path, monkeypatch):
+    lines = ["# Contents", "{% highlight python %}"] + ["# comment"] * 2000 + ["{% endhighlight %}"]
+    lines += ["## Header", "text", "Setext", "------"] * 2000
+    path = tmp_path / "large.md"
+    path.write_text('\n'.join(lines) + '\n')
+    expect = ''.join(line + '\n' for line in mdtoc.MdToc().rewrite_lines(list(lines)))
+    monkeypatch.setattr(mdtoc, "PARALLEL_SCAN_MIN_CHUNK_SIZE", 1000)
+    assert mdtoc.add_toc_file(mdtoc.MdToc(), str(path), scan_jobs=4)
+    assert expect == path.read_text()
+
+def test_scan_jobs_rejects_other_modes(monkeypatch, capsys):
+    for option in ["--jobs=2", "--check", "--stream"]:
+        monkeypatch.setattr(sys, "argv", ["mdtoc.py", "--scan_jobs=4", option, "article.md"])
+        with pytest.raises(SystemExit):
+            mdtoc.parse_command_line_arguments()
+        assert "--scan_jobs cannot be combined" in capsys.readouterr().err
+
+def test_main_staged_refuses_partially_staged_files(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a.md").write_text("# Contents\n")
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+    (tmp_path / "a.md").write_text("# Contents\n# H\n")
+    git("add", "a.md")
+    (tmp_path / "a.md").write_text("# Contents\n# H\nunstaged draft\n")
+
+    monkeypatch.setattr(sys, "argv", ["mdtoc.py", "--staged", "."])
+    with pytest.raises(SystemExit):
+        mdtoc.main()
+
+    assert "unstaged changes" in capsys.readouterr().err
+    assert "# Contents\n# H\nunstaged draft\n" == (tmp_path / "a.md").read_text()
+    staged = subprocess.run(['git', 'diff', '--cached'], stdout=subprocess.PIPE).stdout.decode()
+    assert "unstaged draft" not in staged